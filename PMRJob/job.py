@@ -1,49 +1,247 @@
+import hashlib
+import importlib.util
 import os
 
 from PMRJob.sub_job import *
 from filesystems import SimpleFileSystem
 
 
-def hashcode(s):
+class Job(object):
     """
-    Return the hashcode of a string
+    A submitted job: its stages, their tasks and the submitter to tell
+    when they are done
 
-    https://gist.github.com/hanleybrand/5224673
-    :param s:
-    :return: int
+    Several jobs run at once, each keeps its intermediate files and
+    output in its own directories (see SimpleFileSystem)
     """
-    h = 0
-    for c in s:
-        h = (31 * h + ord(c)) & 0xFFFFFFFF
-    return ((h + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+    def __init__(self, id, submitter, stages, data_path, codec=None,
+                 reduce_slowstart=REDUCE_SLOWSTART, priority=0, output_base_path='output'):
+        self.id = id
+        self.name = 'job_{}'.format(id)
+        self.submitter = submitter
+        self.stages = stages
+        self.data_path = data_path
+        self.codec = codec
+        self.reduce_slowstart = reduce_slowstart
+        # Jobs with a higher priority get idle workers first
+        self.priority = priority
+
+        self.sub_jobs = TaskIndex(stages)  # Tasks of every stage, in the order they were created
+        self.output_path = os.path.join(output_base_path, self.name)
+        # key and state to save when the job is incremental
+        self.incremental_run = None
+
+        for stage in stages:
+            stage.job_name = self.name
+
+    def __str__(self):
+        return '<Job: name={name} priority={priority} stages={stages}>'.format(
+            name=self.name,
+            priority=self.priority,
+            stages=len(self.stages)
+        )
+
+    def get_filesystem(self):
+        return SimpleFileSystem(output_base_path=self.output_path, job=self.name)
+
+    def get_stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def update_stages(self, get_next_job_id):
+        """
+        Create the tasks of each stage as its input becomes ready
+        :param get_next_job_id:
+        :return: whether the map phase of a stage just ended
+        """
+        maps_done = False
+        for stage in self.stages:
+            # Each finished reducer of an input stage is mapped by one task
+            for input_stage in [self.get_stage(name) for name in stage.inputs]:
+                for job in input_stage.reduce_jobs:
+                    if job.done and job.id not in stage.mapped_inputs:
+                        stage.mapped_inputs.add(job.id)
+                        data_path = input_stage.get_filesystem().get_output_file(job.partition_num, self.codec)
+                        setup_stage_input_task(data_path, stage, self.sub_jobs, get_next_job_id)
+
+            # Reducers start fetching map output before the last maps finish
+            num_maps_done = stage.num_maps_done()
+            if not stage.reduce_jobs and num_maps_done >= self.reduce_slowstart * stage.num_maps:
+                setup_reducing_tasks(stage, self.sub_jobs, get_next_job_id)
+
+            if not stage.maps_done and num_maps_done == stage.num_maps:
+                stage.maps_done = True
+                maps_done = True
+        return maps_done
+
+    def is_waiting_reducer(self, job):
+        return job.instruction_type == 'Reducer' and not self.get_stage(job.stage).maps_done
 
+    def get_next_task(self, waiting_reducers=False, maps_only=False):
+        """
+        The oldest task without a worker
+        :param waiting_reducers: pick among reducers waiting for map output
+        :param maps_only: pick among map tasks
+        :return: SubJob or None
+        """
+        tasks = []
+        if not waiting_reducers:
+            tasks.append(self.sub_jobs.get_oldest_unassigned('Mapper'))
+        if not maps_only:
+            # A job has few reducers
+            tasks += [j for j in self.sub_jobs.get_unassigned('Reducer')
+                      if self.is_waiting_reducer(j) == waiting_reducers]
+        return min([j for j in tasks if j], key=lambda j: j.id, default=None)
 
-def setup_mapping_tasks(data_path, mapper_name, num_workers, sub_jobs, get_next_job_id):
+    def num_unassigned_tasks(self):
+        """
+        Tasks without a worker, reducers waiting for map output aside
+        :return: int
+        """
+        return self.sub_jobs.num_unassigned('Mapper') + len(
+            [j for j in self.sub_jobs.get_unassigned('Reducer') if not self.is_waiting_reducer(j)])
+
+    def get_running_waiting_reducers(self):
+        return [j for j in self.sub_jobs.get_running('Reducer') if self.is_waiting_reducer(j)]
+
+    def num_running_tasks(self):
+        return self.sub_jobs.num_running()
+
+    def finished(self):
+        """
+        Return whether the reducers of every stage have completed
+        :return:
+        """
+        return bool(self.stages) and all(stage.finished() for stage in self.stages)
+
+
+def setup_mapping_tasks(data_path, stage, split_size, sub_jobs, get_next_job_id, start=0, end=None):
     # partitions = chunk_input_data(data_path)
-    partitions = chunk_input_data_by_size_and_workers(data_path, num_workers)
+    splits = split_input_data_by_size(data_path, split_size, start, end)
+    stage.num_maps = len(splits)
 
-    for index, partition_path in enumerate(partitions):
-        sub_jobs.append(SubJob(
+    for path, start, end in splits:
+        job = SubJob(
             id=get_next_job_id(),
-            instruction_path=mapper_name,
-            num_workers=num_workers,
+            instruction_path=stage.mapper,
+            num_partitions=stage.num_reducers,
             instruction_type='Mapper',
-            data_path=partition_path,
+            data_path=path,
+            data_start=start,
+            data_end=end,
+            stage=stage.name,
+            job_name=stage.job_name,
             do_after=[set_result_file]
-        ))
+        )
+        stage.map_jobs.append(job)
+        sub_jobs.append(job)
 
 
-def setup_reducing_tasks(reducer_name, num_reducers, sub_jobs, get_next_job_id):
+def setup_stage_input_task(data_path, stage, sub_jobs, get_next_job_id):
+    # Map a whole output partition of an earlier stage
+    job = SubJob(
+        id=get_next_job_id(),
+        instruction_path=stage.mapper,
+        num_partitions=stage.num_reducers,
+        instruction_type='Mapper',
+        data_path=data_path,
+        stage=stage.name,
+        job_name=stage.job_name,
+        do_after=[set_result_file]
+    )
+    stage.map_jobs.append(job)
+    sub_jobs.append(job)
+
+
+def setup_reducing_tasks(stage, sub_jobs, get_next_job_id):
     # For each partition, create a reducer job
-    for index in range(num_reducers):
-        sub_jobs.append(SubJob(
+    for index in range(stage.num_reducers):
+        job = SubJob(
             id=get_next_job_id(),
-            instruction_path=reducer_name,
-            num_workers=num_reducers,
+            instruction_path=stage.reducer,
+            num_partitions=stage.num_reducers,
             instruction_type='Reducer',
             partition_num=index,
+            num_maps=stage.num_maps,
+            stage=stage.name,
+            job_name=stage.job_name,
+            previous_output=stage.previous_outputs[index] if stage.previous_outputs else None,
             do_after=[set_result_file]
-        ))
+        )
+        stage.reduce_jobs.append(job)
+        sub_jobs.append(job)
+
+
+def get_map_task_fingerprint(job, codec=None):
+    """
+    Identify the output of a map task over a byte range of a file
+    It changes with the mapper module (and so its Combiner and Partitioner),
+    the input file, the range and the job's partitioning
+    :param job: a map SubJob
+    :param codec: the job's codec
+    :return: hex digest
+    """
+    fingerprint = hashlib.sha1()
+    with open(importlib.util.find_spec(job.instruction_path).origin, 'rb') as f:
+        fingerprint.update(f.read())
+    stat = os.stat(job.data_path)
+    fingerprint.update(repr((
+        os.path.abspath(job.data_path), stat.st_mtime_ns, stat.st_size,
+        job.data_start, job.data_end, job.num_partitions, codec
+    )).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def get_split_cache_key(job):
+    """
+    Identify the input of a map task, workers keep the inputs they
+    were sent under it
+    :param job: a map SubJob
+    :return: hex digest
+    """
+    stat = os.stat(job.data_path)
+    return hashlib.sha1(repr((
+        os.path.abspath(job.data_path), stat.st_mtime_ns, stat.st_size, job.data_start, job.data_end
+    )).encode('utf-8')).hexdigest()
+
+
+def get_incremental_key(data_path, mapper_name, reducer_name):
+    """
+    Identify the runs of an incremental job
+    :return: hex digest
+    """
+    return hashlib.sha1(repr((os.path.abspath(data_path), mapper_name, reducer_name)).encode('utf-8')).hexdigest()
+
+
+def get_input_checksum(data_path, end, length=4096):
+    """
+    Checksum of the bytes just before end, to tell whether a file that
+    was processed up to end has only been appended to since
+    :return: hex digest
+    """
+    with open(data_path, 'rb') as f:
+        f.seek(max(0, end - length))
+        return hashlib.sha1(f.read(min(end, length))).hexdigest()
+
+
+def get_last_line_end(data_path, block_size=1 << 16):
+    """
+    Offset just past the last complete line of a file
+    A line still being written is left for the next run
+    :return: int
+    """
+    with open(data_path, 'rb') as f:
+        end = os.path.getsize(data_path)
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            index = f.read(end - start).rfind(b'\n')
+            if index >= 0:
+                return start + index + 1
+            end = start
+    return 0
 
 
 def get_job_result_file_path(num_partitions):
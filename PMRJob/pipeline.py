@@ -0,0 +1,113 @@
+import importlib
+import os
+
+from filesystems import SimpleFileSystem
+
+
+class Stage(object):
+    """
+    One map/reduce step of a pipeline
+
+    A stage maps the job's data file, or the reducer output of the
+    stages named in inputs. Each output partition of an input stage is
+    mapped by its own task as soon as it is written, so data is not
+    split again between stages
+    """
+    def __init__(self, name, mapper, reducer, inputs=None, num_reducers=None):
+        self.name = name
+        self.mapper = mapper
+        self.reducer = reducer
+        self.inputs = inputs or []
+        self.num_reducers = num_reducers
+
+        # Set by the server while the job runs
+        self.num_maps = 0
+        self.map_jobs = []
+        self.reduce_jobs = []
+        self.mapped_inputs = set()  # ids of input reduce tasks that have a map task
+        self.num_done = {'Mapper': 0, 'Reducer': 0}  # finished tasks by type, kept by the job's TaskIndex
+        self.output_path = None
+        self.maps_done = False
+        self.previous_outputs = None  # last run's output files of an incremental job
+        self.job_name = None
+
+    def __str__(self):
+        return '<Stage: name={name} mapper={mapper} reducer={reducer} inputs={inputs}>'.format(
+            name=self.name,
+            mapper=self.mapper,
+            reducer=self.reducer,
+            inputs=self.inputs
+        )
+
+    def get_filesystem(self):
+        """
+        The filesystem holding this stage's map output and reducer output
+        :return: SimpleFileSystem
+        """
+        return SimpleFileSystem(output_base_path=self.output_path, stage=self.name, job=self.job_name)
+
+    def num_maps_done(self):
+        return self.num_done['Mapper']
+
+    def finished(self):
+        return bool(self.reduce_jobs) and self.num_done['Reducer'] == len(self.reduce_jobs)
+
+
+def load_pipeline(package_path):
+    """
+    Read the stages of a pipeline module
+    Example path: PMRProcessing.pipeline.word_frequency
+    :param package_path: a module with a list of Stage named stages
+    :return: new Stage instances, so runs of the same pipeline don't share state
+    """
+    pkg = importlib.import_module(package_path)
+    return [Stage(s.name, s.mapper, s.reducer, list(s.inputs), s.num_reducers) for s in pkg.stages]
+
+
+def check_pipeline(stages):
+    """
+    Check that stages form a DAG: names are unique and each stage only
+    reads stages listed before it
+    :param stages:
+    :return: the reason the pipeline is invalid, None if it is valid
+    """
+    if not stages:
+        return 'Pipeline has no stages'
+
+    names = set()
+    for stage in stages:
+        if not stage.name or stage.name in names:
+            return 'Stage names must be set and unique'
+        for name in stage.inputs:
+            if name not in names:
+                return 'Stage {} reads {}, which is not an earlier stage'.format(stage.name, name)
+        names.add(stage.name)
+    return None
+
+
+def get_final_stages(stages):
+    """
+    Stages whose output no other stage reads
+    :param stages:
+    :return: list of Stage
+    """
+    inputs = set(name for stage in stages for name in stage.inputs)
+    return [stage for stage in stages if stage.name not in inputs]
+
+
+def set_output_paths(stages, output_base_path='output'):
+    """
+    Final stages write to output_base_path, in a directory per stage if
+    there are several. Other stages keep their output next to their map output
+    :param stages:
+    :param output_base_path:
+    :return:
+    """
+    final_stages = get_final_stages(stages)
+    for stage in stages:
+        if stage not in final_stages:
+            stage.output_path = SimpleFileSystem(stage=stage.name, job=stage.job_name).get_stage_output_path()
+        elif len(final_stages) > 1:
+            stage.output_path = os.path.join(output_base_path, stage.name)
+        else:
+            stage.output_path = output_base_path
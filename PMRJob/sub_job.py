@@ -1,7 +1,18 @@
+import heapq
 import os
 
 from filesystems import SimpleFileSystem
-from math import ceil, inf
+from math import ceil
+
+# Splits created per worker when a job doesn't set a split size
+SPLITS_PER_WORKER = 4
+
+# Smallest split created by default, in bytes
+MIN_SPLIT_SIZE = 1 << 16
+
+# Fraction of map tasks done before reduce tasks are scheduled by default,
+# so reducers fetch finished map output while the last maps run
+REDUCE_SLOWSTART = 0.8
 
 
 def chunk_input_data(data_path, lines_per_partition=500):
@@ -33,44 +44,30 @@ def chunk_input_data(data_path, lines_per_partition=500):
     return partition_paths
 
 
-def chunk_input_data_by_size_and_workers(data_path, n_workers):
+def get_default_split_size(data_path, n_workers, start=0, end=None):
     """
-    Create n_workers partitions of roughly equal number of bytes
-    :return:
+    Pick a split size that gives each worker several splits, so that
+    fast workers can take on more of them than slow ones
+    :param start: first byte of the input that is read
+    :param end: byte after the input that is read, None for the end of the file
+    :return: int
     """
-    partition = -1
-    partition_paths = []
-    partition_handlers = []
-
+    input_size = (os.path.getsize(data_path) if end is None else end) - start
+    return max(MIN_SPLIT_SIZE, ceil(input_size / (1.0 * n_workers * SPLITS_PER_WORKER)))
 
-    # TODO main server should be aware of these values as they impact the 
-    # progress measure
-    file_size = os.path.getsize(data_path)
-    # round up since rounding down can cause more chunks than workers (very bad)
-    chunk_size = ceil(file_size / (1.0*n_workers))
 
-    fs = SimpleFileSystem()
-    bytes_chunked = inf # immediately create partition
-    with fs.open(data_path, 'r') as f:
-        for line in f:
-            if bytes_chunked >= chunk_size:
-                # Clean up open descriptor
-                if partition_handlers:
-                    fs.close(partition_handlers[partition])
-
-                # Create new partition
-                partition += 1
-                partition_paths.append(fs.get_writeable_file_path())
-                partition_handlers.append(fs.open(partition_paths[partition], 'w'))
-
-                bytes_chunked = 0
-
-            partition_handlers[partition].write(line)
-            bytes_chunked += len(line) # assuming char is 1 byte (hopefully a safe assumption)
-
-    fs.close(partition_handlers[partition])
+def split_input_data_by_size(data_path, split_size, start=0, end=None):
+    """
+    Describe splits of split_size bytes covering the input, or the
+    byte range [start, end) of it
 
-    return partition_paths 
+    Nothing is read or copied here, each mapper reads its own byte
+    range of the input (see SimpleFileSystem.open_split)
+    :return: list of (path, start_offset, end_offset)
+    """
+    end = os.path.getsize(data_path) if end is None else end
+    return [(data_path, split_start, min(split_start + split_size, end))
+            for split_start in range(start, end, split_size)]
 
 
 def set_result_file(job, path):
@@ -89,11 +86,28 @@ class SubJob:
                  instruction_path,
                  instruction_type,
                  data_path=None,
-                 num_workers=0,
+                 num_partitions=0,
+
+                 # Byte range of data_path read by mappers
+                 data_start=0,
+                 data_end=None,
 
                  # Used by reducers to denote their output files
                  partition_num=0,
 
+                 # Used by reducers to know when all map output is in
+                 num_maps=None,
+
+                 # Name of the pipeline stage, None for a single stage job
+                 stage=None,
+
+                 # Name of the submitted job the task belongs to
+                 job_name=None,
+
+                 # Used by reducers of incremental jobs, the output of the
+                 # last run for their partition to merge with
+                 previous_output=None,
+
                  # Anything to do before running, gets passed this instance
                  # Can be a single function or a list
                  # If data_path is not set on create, do_before must set it
@@ -107,30 +121,113 @@ class SubJob:
         self.instruction_path = instruction_path
         self.instruction_type = instruction_type
         self.data_path = data_path
-        self.num_workers = num_workers
+        self.data_start = data_start
+        self.data_end = data_end
+        self.num_partitions = num_partitions
         self.partition_num = partition_num
+        self.num_maps = num_maps
+        self.stage = stage
+        self.job_name = job_name
+        self.previous_output = previous_output
 
         self.do_before = do_before
         self.do_after = do_after
 
         self.result_file = None
 
-        self.client = None
+        # Set for map tasks whose output can be cached across jobs
+        self.fingerprint = None
+
+        # Where reducers fetch the output of a finished map task,
+        # (host, port, output id) of a shuffle server, and its size in bytes
+        self.map_output = None
+        self.output_size = 0
+
+        # Running attempts of this task, attempt_id -> WorkerConnection
+        # A backup attempt may be started for a straggler, the first
+        # attempt to finish wins and the others are cancelled
+        self.attempts = dict()
+        self.num_attempts = 0
         self.pending_assignment = True
 
-        self.done = False
+        # The TaskIndex of the job the task belongs to, told when its state changes
+        self.index = None
+        self._done = False
+
+    @property
+    def done(self):
+        return self._done
+
+    @done.setter
+    def done(self, done):
+        self._done = done
+        self.update_index()
+
+    def update_index(self):
+        if self.index:
+            self.index.update(self)
+
+    @property
+    def client(self):
+        """
+        The connection of the oldest running attempt, None if there is none
+        """
+        return next(iter(self.attempts.values()), None)
 
     def __str__(self):
-        return '<SubJob: id={id} instruction_type={instruction_type} data_path={data_path} client={client} partition_num={partition_num} pending_assignment={assigned} done={done}'.format(
+        return '<SubJob: id={id} job_name={job_name} stage={stage} instruction_type={instruction_type} data_path={data_path} data_range={start}-{end} client={client} attempts={attempts} partition_num={partition_num} pending_assignment={assigned} done={done}'.format(
             id=self.id,
+            job_name=self.job_name,
+            stage=self.stage,
             instruction_type=self.instruction_type,
             data_path=self.data_path,
+            start=self.data_start,
+            end=self.data_end,
             client=self.client,
+            attempts=len(self.attempts),
             partition_num=self.partition_num,
             assigned = self.pending_assignment,
             done = self.done
         )
 
+    def add_attempt(self, connection):
+        """
+        Start a new attempt of this task on connection
+        :param connection:
+        :return: the attempt id
+        """
+        self.num_attempts += 1
+        attempt_id = '{}_{}'.format(self.id, self.num_attempts)
+        self.attempts[attempt_id] = connection
+        self.update_index()
+        return attempt_id
+
+    def remove_attempt(self, attempt_id):
+        """
+        Forget an attempt that was lost or cancelled
+        :param attempt_id:
+        :return: the attempt's connection, None if it was not running
+        """
+        connection = self.attempts.pop(attempt_id, None)
+        self.update_index()
+        return connection
+
+    def reset(self):
+        """
+        Run a finished task again, its output was lost. Attempts still
+        being set up go on, the task is assigned again if there are none
+        :return:
+        """
+        for attempt_id, conn in list(self.attempts.items()):
+            if conn.current_job is not self:
+                del self.attempts[attempt_id]
+        if not self.attempts:
+            self.pending_assignment = False
+        self.result_file = None
+        self.map_output = None
+        self.output_size = 0
+        self.done = False
+
     def pre_execute(self):
         """
         Run any do_before methods that were specified
@@ -155,3 +252,105 @@ class SubJob:
         if type(self.do_after) is list:
             for action in self.do_after:
                 action(self, output_path)
+
+
+class TaskIndex(object):
+    """
+    The tasks of a job, in the order they were created, indexed by state
+    so the scheduler doesn't scan them: unassigned tasks by instruction
+    type, running ones and the number of finished ones of each stage
+
+    A task is unassigned while it has no attempt and isn't done, running
+    while it has one. Tasks tell the index when they change
+    """
+    UNASSIGNED, RUNNING, DONE = range(3)
+
+    def __init__(self, stages):
+        self.tasks = []
+        # name -> Stage, whose counts of finished tasks are kept here
+        self.stages = {stage.name: stage for stage in stages}
+        self.states = dict()
+
+        # instruction type -> unassigned tasks, and a heap of (id, task) that
+        # finds the oldest. Entries of tasks that were assigned since are
+        # dropped when they reach the top
+        self.unassigned = {'Mapper': set(), 'Reducer': set()}
+        self.unassigned_heaps = {'Mapper': [], 'Reducer': []}
+        self.heaped = set()
+
+        # instruction type -> running tasks
+        self.running = {'Mapper': set(), 'Reducer': set()}
+        self.num_done = 0
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def append(self, task):
+        self.tasks.append(task)
+        task.index = self
+        self.update(task)
+
+    def get_state(self, task):
+        if task.done:
+            return self.DONE
+        return self.RUNNING if task.attempts else self.UNASSIGNED
+
+    def update(self, task):
+        """
+        Move a task to the index of its current state
+        :param task:
+        :return:
+        """
+        state = self.get_state(task)
+        previous_state = self.states.get(task)
+        if state == previous_state:
+            return
+        self.states[task] = state
+
+        if previous_state == self.UNASSIGNED:
+            self.unassigned[task.instruction_type].discard(task)
+        elif previous_state == self.RUNNING:
+            self.running[task.instruction_type].discard(task)
+        elif previous_state == self.DONE:
+            self.num_done -= 1
+            self.stages[task.stage].num_done[task.instruction_type] -= 1
+
+        if state == self.UNASSIGNED:
+            self.unassigned[task.instruction_type].add(task)
+            if task not in self.heaped:
+                self.heaped.add(task)
+                heapq.heappush(self.unassigned_heaps[task.instruction_type], (task.id, task))
+        elif state == self.RUNNING:
+            self.running[task.instruction_type].add(task)
+        else:
+            self.num_done += 1
+            self.stages[task.stage].num_done[task.instruction_type] += 1
+
+    def get_oldest_unassigned(self, instruction_type):
+        """
+        :param instruction_type: 'Mapper' or 'Reducer'
+        :return: the unassigned task of that type created first, None if there is none
+        """
+        heap = self.unassigned_heaps[instruction_type]
+        while heap and heap[0][1] not in self.unassigned[instruction_type]:
+            self.heaped.discard(heapq.heappop(heap)[1])
+        return heap[0][1] if heap else None
+
+    def get_unassigned(self, instruction_type=None):
+        if instruction_type:
+            return list(self.unassigned[instruction_type])
+        return list(self.unassigned['Mapper']) + list(self.unassigned['Reducer'])
+
+    def num_unassigned(self, instruction_type=None):
+        if instruction_type:
+            return len(self.unassigned[instruction_type])
+        return len(self.unassigned['Mapper']) + len(self.unassigned['Reducer'])
+
+    def get_running(self, instruction_type):
+        return list(self.running[instruction_type])
+
+    def num_running(self):
+        return len(self.running['Mapper']) + len(self.running['Reducer'])
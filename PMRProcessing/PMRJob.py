@@ -7,6 +7,16 @@ class PMRJob(metaclass=ABCMeta):
     run on clients
     """
 
+    # Set when another attempt of the same task finished first
+    cancelled = False
+
+    def cancel(self):
+        """
+        Ask the job to stop early, it checks cancelled as it runs
+        :return:
+        """
+        self.cancelled = True
+
     @abstractmethod
     def run(self):
         """
@@ -1,3 +1,4 @@
+import threading
 from threading import Timer
 import time
 import sys
@@ -36,6 +37,9 @@ class BeatingProcess:
 
 	def EndHeartbeat(self, immediate=False):
 		self.heartbeat.cancel()
+		# wait for a beat in progress so it doesn't overlap the last one
+		if self.heartbeat is not threading.current_thread():
+			self.heartbeat.join()
 		if (not immediate):
 			self.Beat() # beat one last time before dying
 		self.DieMethod() # call die method
@@ -1,3 +1,10 @@
+# NumPy is optional, map_batch falls back to plain pairs without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
 class Mapper():
 
     def map(self, key, value, output):
@@ -12,3 +19,17 @@ class Mapper():
         time = float(values[1][1:-1])  # '(0.000)' --> 0.000
 
         output.append(('avg', time))
+
+    def map_batch(self, lines):
+        """
+        Convert a block of db log records at once
+        :param lines:
+        :return: (keys, values) arrays, or a list of pairs without NumPy
+        """
+        times = [line.split(None, 2)[1][1:-1] for line in lines]  # '(0.000)' --> 0.000
+
+        if np is None:
+            return [('avg', float(time)) for time in times]
+
+        times = np.array(times, dtype=np.float64)
+        return np.full(len(times), 'avg'), times
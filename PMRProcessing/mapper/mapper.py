@@ -1,30 +1,320 @@
-from PMRJob.job import hashcode
+from functools import lru_cache
+from itertools import groupby, islice
+
 from PMRProcessing.PMRJob import PMRJob
 from PMRProcessing.heartbeat.heartbeat import *
+from PMRProcessing.partitioner import HashPartitioner
+from PMRProcessing.records import RecordWriter, RUN_RECORD_HEADER, TYPE_FLOAT, TYPE_INT
+from PMRProcessing.spill import run_writer, merge_runs
 import time
 
 from filesystems import SimpleFileSystem
 
+# NumPy is only needed by jobs whose map_batch returns arrays
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of buffered (key, value) pairs before the combiner
+# is run over the in-memory map output
+COMBINE_THRESHOLD = 10000
+
+# Number of buffered (key, value) pairs before the map output
+# is sorted and spilled to a run file on disk
+SORT_BUFFER_SIZE = 100000
+
+# Maximum number of spill runs merged in a single pass
+MERGE_FACTOR = 10
+
+# Number of distinct keys whose partition is remembered
+PARTITION_CACHE_SIZE = 65536
+
+# Number of input lines handed to map_batch at a time
+MAP_BATCH_SIZE = 1000
+
 
 class Mapper(BeatingProcess, PMRJob):
     """
     @brief Class for mapper.
     """
-    def __init__(self, key, mapper_cls, num_workers, heartbeat_id="Mapper", in_stream=sys.stdout, slow_mode=False):
+    def __init__(self, key, mapper_cls, num_partitions, combiner_cls=None, partitioner_cls=HashPartitioner,
+                 heartbeat_id="Mapper", in_stream=sys.stdout, slow_mode=False, combine_threshold=COMBINE_THRESHOLD,
+                 sort_buffer_size=SORT_BUFFER_SIZE, merge_factor=MERGE_FACTOR, batch_size=MAP_BATCH_SIZE,
+                 codec=None, attempt_id=None, stage=None, job_name=None):
         BeatingProcess.__init__(self)
         self.heartbeat_id = heartbeat_id
         self.in_stream = in_stream
         self.slow_mode = slow_mode
         self.mapper = mapper_cls()
+        self.combiner = combiner_cls() if combiner_cls else None
+        self.combine_threshold = combine_threshold
+        self.sort_buffer_size = sort_buffer_size
+        self.merge_factor = merge_factor
+        self.batch_size = batch_size
+        self.codec = codec
+        self.attempt_id = attempt_id
+        self.stage = stage
+        self.job_name = job_name
         self.key = key
-        self.num_workers = num_workers
+        self.num_partitions = num_partitions
+
+        # Keys repeat a lot in map output (e.g. words), so remember
+        # the partition of recently seen keys
+        self.partitioner = partitioner_cls(num_partitions)
+        self.get_partition = lru_cache(maxsize=PARTITION_CACHE_SIZE)(self.partitioner.get_partition)
+
+        # Paths of the sorted runs spilled so far
+        self.spill_files = []
+
+    def combine(self, output):
+        """
+        Pre-aggregate the buffered map output with the job's combiner
+        :param output: list of (key, value) pairs
+        :return: the combined list of (key, value) pairs
+        """
+        key_vals_map = {}
+        for key, value in output:
+            if key in key_vals_map:
+                key_vals_map[key].append(value)
+            else:
+                key_vals_map[key] = [value]
+
+        combined = []
+        for key, values in key_vals_map.items():
+            self.combiner.combine(key, values, combined)
+        return combined
+
+    def write_grouped(self, records, write):
+        """
+        Write records sorted by (partition, key), running the combiner
+        over the values of each key first if the job has one
+        :param records: iterable of (partition, key, value)
+        :param write: function called with each (partition, key, value)
+        :return:
+        """
+        if not self.combiner:
+            # Records are streamed, a key with many values is never held in memory
+            for partition_num, key, value in records:
+                write(partition_num, key, value)
+            return
+
+        for (partition_num, key), group in groupby(records, key=lambda record: (record[0], record[1])):
+            # Combine at spill time so each key is written
+            # at most once per run
+            combined = []
+            self.combiner.combine(key, [record[2] for record in group], combined)
+            for _, value in combined:
+                write(partition_num, key, value)
+
+    def spill(self, output):
+        """
+        Sort the buffered map output and write it to a new run file
+        :param output: list of (key, value) pairs
+        :return:
+        """
+        # Before spilling output to disk, mapper needs to quicksort based
+        # on which partition the (key, value) pairs will be sent to
+        # sort by (partitionIndex, key)
+        # The partition is computed once per record and carried through
+        # the sort, the run files and the final merge
+        # Keys are compared as strings once they are on disk, so they are
+        # sorted as strings here too. The partition is still computed on the key
+        get_partition = self.get_partition
+        records = [(get_partition(key), str(key), value) for key, value in output]
+        records.sort(key=lambda record: (record[0], record[1]))
+
+        sf = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        path = sf.get_spill_file(self.attempt_id)
+        run_file = sf.open(path, 'wb', codec=self.codec)
+        writer = run_writer(run_file)
+        self.write_grouped(records, lambda p, k, v: writer.write(k, v, p))
+        writer.flush()
+        sf.close(run_file)
+        self.spill_files.append(path)
+
+    def spill_arrays(self, keys, values):
+        """
+        Sort columnar map output and write it to a new run file
+        without building a tuple per record
+        :param keys: NumPy array of keys
+        :param values: NumPy array of values, same length as keys
+        :return:
+        """
+        # Partition each distinct key once, on the key itself as the
+        # pairs path does
+        unique_keys, key_index = np.unique(keys, return_inverse=True)
+        key_partitions = np.array([self.get_partition(key) for key in unique_keys.tolist()], dtype=np.int64)
+        partitions = key_partitions[key_index]
+
+        # Keys are compared as strings once they are on disk, so
+        # sort them as strings here too
+        str_keys = unique_keys.astype(str)
+        str_order = np.argsort(str_keys, kind='stable')
+        key_ranks = np.empty_like(str_order)
+        key_ranks[str_order] = np.arange(len(str_order))
+        unique_keys = str_keys[str_order]
+        key_index = key_ranks[key_index]
+
+        order = np.lexsort((key_index, partitions))
+        partitions = partitions[order]
+        key_index = key_index[order]
+        values = values[order]
+
+        if values.dtype.kind == 'f':
+            value_type, value_dtype = TYPE_FLOAT, '>f8'
+        # Unsigned values past the int64 range are written one by one, as big ints
+        elif values.dtype.kind in 'bi' or (values.dtype.kind == 'u' and
+                                           (not len(values) or values.max() <= np.iinfo(np.int64).max)):
+            value_type, value_dtype = TYPE_INT, '>i8'
+        else:
+            value_type, value_dtype = None, None
+
+        sf = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        path = sf.get_spill_file(self.attempt_id)
+        run_file = sf.open(path, 'wb', codec=self.codec)
+        writer = run_writer(run_file)
+        if self.combiner or value_type is None:
+            self.write_grouped(
+                zip(partitions.tolist(), unique_keys[key_index].tolist(), values.tolist()),
+                lambda p, k, v: writer.write(k, v, p)
+            )
+        else:
+            # Every record of a key shares the same header and key bytes,
+            # so build each key's records as one block of rows
+            value_bytes = values.astype(value_dtype).view(np.uint8).reshape(-1, 8)
+            bounds = np.flatnonzero(np.diff(key_index)) + 1
+            starts = np.concatenate(([0], bounds)).tolist()
+            ends = np.concatenate((bounds, [len(key_index)])).tolist()
+            for start, end in zip(starts, ends):
+                key_data = unique_keys[key_index[start]].encode('utf-8')
+                prefix = RUN_RECORD_HEADER.pack(int(partitions[start]), len(key_data), value_type, 8) + key_data
+                block = np.empty((end - start, len(prefix) + 8), dtype=np.uint8)
+                block[:, :len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+                block[:, len(prefix):] = value_bytes[start:end]
+                writer.write_encoded(block.tobytes())
+        writer.flush()
+        sf.close(run_file)
+        self.spill_files.append(path)
+
+    def merge_spills(self, paths):
+        """
+        Merge several runs into a single new run
+        :param paths: paths of the runs to merge
+        :return: path of the merged run
+        """
+        sf = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        run_files = [sf.open(path, 'rb', codec=self.codec) for path in paths]
+        path = sf.get_spill_file(self.attempt_id)
+        merged_file = sf.open(path, 'wb', codec=self.codec)
+        writer = run_writer(merged_file)
+        self.write_grouped(merge_runs(run_files), lambda p, k, v: writer.write(k, v, p))
+        writer.flush()
+        sf.close(merged_file)
+
+        for path_merged, run_file in zip(paths, run_files):
+            sf.close(run_file)
+            sf.remove(path_merged)
+        return path
+
+    def write_partitions(self):
+        """
+        Merge all spilled runs into one output file per partition
+        :return:
+        """
+        # Keep the number of simultaneously open runs bounded
+        while len(self.spill_files) > self.merge_factor:
+            paths = self.spill_files[:self.merge_factor]
+            self.spill_files = self.spill_files[self.merge_factor:]
+            self.spill_files.append(self.merge_spills(paths))
+
+        sf = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        partition_files = []
+        for i in range(self.num_partitions):
+            partition_files.append(
+                sf.open(sf.get_mapper_output_file(i, self.attempt_id), 'wb', codec=self.codec)
+            )
+        writers = [RecordWriter(partition_file) for partition_file in partition_files]
+
+        run_files = [sf.open(path, 'rb', codec=self.codec) for path in self.spill_files]
+        self.write_grouped(
+            merge_runs(run_files),
+            lambda p, k, v: writers[p].write(k, v)
+        )
+
+        for path, run_file in zip(self.spill_files, run_files):
+            sf.close(run_file)
+            sf.remove(path)
+        self.spill_files = []
+
+        for writer, partition_file in zip(writers, partition_files):
+            writer.flush()
+            sf.close(partition_file)
+
+    def map_batches(self):
+        """
+        Feed the input to the user mapper's map_batch a block of lines at a time
+
+        map_batch may return a list of (key, value) pairs, or a (keys, values)
+        pair of NumPy arrays which is buffered and spilled column-wise
+        """
+        output = []
+        combine_threshold = self.combine_threshold
+        key_arrays = []
+        value_arrays = []
+        buffered_arrays = 0
+
+        lines = list(islice(self.in_stream, self.batch_size))
+        while lines:
+            if self.cancelled:
+                return
+            if (self.slow_mode):
+                time.sleep(0.001 * len(lines))
+            result = self.mapper.map_batch(lines)
+            self.progress += sum(len(line) for line in lines)
+
+            if np is not None and type(result) is tuple and len(result) == 2 \
+                    and isinstance(result[0], np.ndarray):
+                key_arrays.append(result[0])
+                value_arrays.append(result[1])
+                buffered_arrays += len(result[0])
+                if buffered_arrays >= self.sort_buffer_size:
+                    self.spill_arrays(np.concatenate(key_arrays), np.concatenate(value_arrays))
+                    key_arrays, value_arrays, buffered_arrays = [], [], 0
+            else:
+                output.extend(result)
+                if self.combiner and len(output) >= combine_threshold:
+                    output = self.combine(output)
+                    # Don't re-combine on every batch when most keys are distinct
+                    combine_threshold = max(self.combine_threshold, 2 * len(output))
+                if len(output) >= self.sort_buffer_size:
+                    self.spill(output)
+                    output = []
+                    combine_threshold = self.combine_threshold
+
+            lines = list(islice(self.in_stream, self.batch_size))
+
+        if key_arrays:
+            self.spill_arrays(np.concatenate(key_arrays), np.concatenate(value_arrays))
+        if output:
+            self.spill(output)
+
+        if not self.cancelled:
+            self.write_partitions()
 
     def map(self):
         """
         Simple count map
         """
+        if hasattr(self.mapper, 'map_batch'):
+            self.map_batches()
+            return
+
         output = []
+        combine_threshold = self.combine_threshold
         for line in self.in_stream:
+            if self.cancelled:
+                return
             # can set this higher or lower for slower speeds
             # this value makes speeds ~10 times slower
             if (self.slow_mode):
@@ -32,27 +322,21 @@ class Mapper(BeatingProcess, PMRJob):
             self.mapper.map(self.key, line, output)
             self.progress += len(line)
 
-        # Before spilling output to disk, mapper needs to quicksort based
-        # on which partition the (key, value) pairs will be sent to
-        # sort by (partitionIndex, key)
-        output.sort(
-            key=lambda pair: (hashcode(pair[0]) % self.num_workers, pair[0])
-        )
+            if self.combiner and len(output) >= combine_threshold:
+                output = self.combine(output)
+                # Don't re-combine on every line when most keys are distinct
+                combine_threshold = max(self.combine_threshold, 2 * len(output))
 
-        # Spill to disk
-        partition_files = []
-        sf = SimpleFileSystem()
-        for i in range(self.num_workers):
-            partition_files.append(
-                sf.open(sf.get_mapper_output_file(i), 'w')
-            )
+            if len(output) >= self.sort_buffer_size:
+                self.spill(output)
+                output = []
+                combine_threshold = self.combine_threshold
 
-        for key, value in output:
-            partition_num = hashcode(key) % self.num_workers
-            partition_files[partition_num].write('%s\t%s\n' % (key, value))
+        if output:
+            self.spill(output)
 
-        for partition_file in partition_files:
-            sf.close(partition_file)
+        if not self.cancelled:
+            self.write_partitions()
 
     def run(self):
         self.progress = 0
@@ -11,4 +11,17 @@ class Mapper():
         value = value.strip()
         words = value.split()
         for word in words:
-            output.append((word, 1))
\ No newline at end of file
+            output.append((word, 1))
+
+
+class Combiner():
+
+    def combine(self, key, values, output):
+        """
+        Sum the counts for a word before they are spilled
+        :param key: word
+        :param values: counts seen for the word so far
+        :param output: what to append result pairs too
+        :return:
+        """
+        output.append((key, sum(int(value) for value in values)))
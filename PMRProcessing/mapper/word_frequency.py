@@ -0,0 +1,12 @@
+class Mapper():
+
+    def map(self, key, value, output):
+        """
+        Count a word of word_count's output under the number of times it occurs
+        :param key: file name
+        :param value: line of word_count's output, word and count separated by a tab
+        :param output: what to append result pairs too
+        :return:
+        """
+        word, count = value.rstrip('\n').split('\t')
+        output.append((count, 1))
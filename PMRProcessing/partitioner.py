@@ -0,0 +1,54 @@
+import zlib
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_right
+
+
+class BasePartitioner(metaclass=ABCMeta):
+    """
+    Decides which reducer partition a map output key is sent to
+
+    A job selects its partitioner by defining a Partitioner class in its
+    mapper module, next to the Mapper. Jobs that don't get a HashPartitioner.
+    """
+    def __init__(self, num_partitions):
+        self.num_partitions = num_partitions
+
+    @abstractmethod
+    def get_partition(self, key):
+        """
+        Return the partition for the key
+        Must give the same answer for the same key on every worker
+        :param key:
+        :return: int in [0, num_partitions)
+        """
+        pass
+
+
+class HashPartitioner(BasePartitioner):
+    """
+    Spread keys evenly over the partitions
+
+    Uses crc32 rather than the builtin hash(), which is randomized
+    per process for strings
+    """
+    def get_partition(self, key):
+        return zlib.crc32(str(key).encode('utf-8')) % self.num_partitions
+
+
+class RangePartitioner(BasePartitioner):
+    """
+    Send contiguous key ranges to each partition so that the
+    concatenated reducer outputs are globally sorted
+
+    Subclass and set boundaries, the sorted upper bounds (exclusive)
+    of every partition but the last
+    """
+    boundaries = []
+
+    def __init__(self, num_partitions, boundaries=None):
+        super().__init__(num_partitions)
+        if boundaries is not None:
+            self.boundaries = boundaries
+
+    def get_partition(self, key):
+        return min(bisect_right(self.boundaries, key), self.num_partitions - 1)
@@ -0,0 +1,8 @@
+from PMRJob.pipeline import Stage
+
+# Count the words, then count how many words occur each number of times
+stages = [
+    Stage('count', 'PMRProcessing.mapper.word_count', 'PMRProcessing.reducer.word_count'),
+    Stage('frequency', 'PMRProcessing.mapper.word_frequency', 'PMRProcessing.reducer.word_count',
+          inputs=['count']),
+]
@@ -0,0 +1,163 @@
+"""
+Binary record format for intermediate map output (spill runs and
+partition files)
+
+Each record is a fixed size header followed by the key and the value:
+    [key_len][value_type][value_len][key][value]
+Run records are additionally prefixed with the partition number.
+Keys are stored as UTF-8 strings, values keep their type so reducers
+get back the ints and floats the mapper emitted.
+"""
+import numbers
+import struct
+
+RECORD_HEADER = struct.Struct('>IBI')
+RUN_RECORD_HEADER = struct.Struct('>IIBI')
+
+TYPE_INT = 0
+TYPE_FLOAT = 1
+TYPE_BYTES = 2
+TYPE_STR = 3
+TYPE_BIG_INT = 4  # ints that don't fit in 8 bytes, stored as decimal text
+
+INT_VALUE = struct.Struct('>q')
+FLOAT_VALUE = struct.Struct('>d')
+
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+# Bytes read or buffered per block
+BLOCK_SIZE = 1 << 16
+
+
+def encode_value(value):
+    """
+    Encode a value with its type
+    Anything that isn't a number, bytes or str is stored as str(value)
+    :param value:
+    :return: (value_type, bytes)
+    """
+    if isinstance(value, numbers.Integral):
+        value = int(value)
+        if INT_MIN <= value <= INT_MAX:
+            return TYPE_INT, INT_VALUE.pack(value)
+        return TYPE_BIG_INT, str(value).encode('ascii')
+    elif isinstance(value, numbers.Real):
+        return TYPE_FLOAT, FLOAT_VALUE.pack(value)
+    elif isinstance(value, (bytes, bytearray)):
+        return TYPE_BYTES, bytes(value)
+    return TYPE_STR, str(value).encode('utf-8')
+
+
+def decode_value(value_type, data):
+    """
+    Inverse of encode_value
+    :param value_type:
+    :param data: bytes-like
+    :return: the value
+    """
+    if value_type == TYPE_INT:
+        return INT_VALUE.unpack(data)[0]
+    elif value_type == TYPE_FLOAT:
+        return FLOAT_VALUE.unpack(data)[0]
+    elif value_type == TYPE_BYTES:
+        return bytes(data)
+    elif value_type == TYPE_BIG_INT:
+        return int(bytes(data))
+    return str(data, encoding='utf-8')
+
+
+def encode_record(key, value, partition_num=None):
+    """
+    Encode a single record
+    :param key:
+    :param value:
+    :param partition_num: included for spill runs, None for partition files
+    :return: bytes
+    """
+    key_data = str(key).encode('utf-8')
+    value_type, value_data = encode_value(value)
+    if partition_num is None:
+        header = RECORD_HEADER.pack(len(key_data), value_type, len(value_data))
+    else:
+        header = RUN_RECORD_HEADER.pack(partition_num, len(key_data), value_type, len(value_data))
+    return header + key_data + value_data
+
+
+class RecordWriter(object):
+    """
+    Buffers encoded records and writes them to a binary file in blocks
+    """
+    def __init__(self, file, with_partition=False):
+        self.file = file
+        self.with_partition = with_partition
+        self.buffer = bytearray()
+
+    def write(self, key, value, partition_num=None):
+        self.buffer += encode_record(key, value, partition_num if self.with_partition else None)
+        if len(self.buffer) >= BLOCK_SIZE:
+            self.flush()
+
+    def write_encoded(self, data):
+        """
+        Write records that were already encoded
+        :param data: bytes-like
+        :return:
+        """
+        self.buffer += data
+        if len(self.buffer) >= BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+
+def read_records(file, with_partition=False, on_read=None):
+    """
+    Stream the records of a binary file a block at a time
+    :param file: file opened in binary mode
+    :param with_partition: whether the records carry a partition number
+    :param on_read: called with the size of each block read, for progress tracking
+    :return: generator of (key, value), or (partition, key, value) if with_partition
+    """
+    header = RUN_RECORD_HEADER if with_partition else RECORD_HEADER
+    header_size = header.size
+    buffer = b''
+    offset = 0
+
+    while True:
+        block = file.read(BLOCK_SIZE)
+        if not block:
+            break
+        if on_read:
+            on_read(len(block))
+        # Keep the incomplete tail of the previous block
+        buffer = buffer[offset:] + block if offset < len(buffer) else block
+        offset = 0
+        view = memoryview(buffer)
+        end = len(buffer)
+
+        while end - offset >= header_size:
+            if with_partition:
+                partition_num, key_len, value_type, value_len = header.unpack_from(buffer, offset)
+            else:
+                key_len, value_type, value_len = header.unpack_from(buffer, offset)
+            key_start = offset + header_size
+            value_start = key_start + key_len
+            record_end = value_start + value_len
+            if record_end > end:
+                break
+
+            key = str(view[key_start:value_start], encoding='utf-8')
+            value = decode_value(value_type, view[value_start:record_end])
+            offset = record_end
+
+            if with_partition:
+                yield partition_num, key, value
+            else:
+                yield key, value
+
+    if offset < len(buffer):
+        raise ValueError('Truncated record at end of file')
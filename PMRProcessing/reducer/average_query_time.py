@@ -3,6 +3,7 @@ class Reducer():
     def reduce(self, key, values, output):
         """
         For the given key, average the values
+        The count is output with the average so runs can be merged
         :param key:
         :param values:
         :param output:
@@ -14,4 +15,22 @@ class Reducer():
             sum += float(value)
             count += 1
 
-        output.append((key, sum/count))
+        output.append((key, '{} {}'.format(sum/count, count)))
+
+    def merge(self, key, values, output):
+        """
+        Combine the averages of different runs of an incremental job,
+        weighted by their counts
+        :param key:
+        :param values: 'average count' strings
+        :param output:
+        :return:
+        """
+        count = 0
+        sum = 0
+        for value in values:
+            average, value_count = value.split()
+            sum += float(average) * int(value_count)
+            count += int(value_count)
+
+        output.append((key, '{} {}'.format(sum/count, count)))
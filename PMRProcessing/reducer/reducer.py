@@ -1,58 +1,233 @@
-from PMRJob.job import hashcode
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import groupby
+
 from PMRProcessing.PMRJob import PMRJob
 from PMRProcessing.heartbeat.heartbeat import *
+from PMRProcessing.records import RecordWriter, read_records
 import time
 
-from filesystems import SimpleFileSystem
+from filesystems import SimpleFileSystem, get_codec_from_path
+from shuffle import fetch_map_output, ShuffleFetchError
+
+# Number of mapper output files merged into one run while
+# the reducer waits for the rest of the map phase
+FETCH_MERGE_FACTOR = 10
+
+# Seconds between looks for newly finished mapper output
+FETCH_INTERVAL = 0.1
+
+# Mapper outputs fetched from other workers at the same time
+PARALLEL_FETCHES = 5
 
 
 class Reducer(BeatingProcess, PMRJob):
     """
     @brief Class for reducer.
     """
-    def __init__(self, reducer_cls, num_workers, partition_num, heartbeat_id="Reducer", slow_mode=False):
+    def __init__(self, reducer_cls, num_partitions, partition_num, heartbeat_id="Reducer", slow_mode=False,
+                 codec=None, attempt_id=None, num_maps=None, merge_factor=FETCH_MERGE_FACTOR, stage=None,
+                 previous_output=None, job_name=None, parallel_fetches=PARALLEL_FETCHES):
         BeatingProcess.__init__(self)
         self.heartbeat_id = heartbeat_id
         self.slow_mode = slow_mode
         self.reducer_cls = reducer_cls
-        self.num_workers = num_workers
+        self.num_partitions = num_partitions
         self.slow_mode = slow_mode
         self.partition_num = partition_num
+        self.codec = codec
+        self.attempt_id = attempt_id
+        self.num_maps = num_maps
+        self.merge_factor = merge_factor
+        self.stage = stage
+        self.previous_output = previous_output
+        self.job_name = job_name
+        self.parallel_fetches = parallel_fetches
 
-    def reduce(self):
-        key_vals_map = {}
-        fs = SimpleFileSystem()
-        files = fs.get_partition_files(self.partition_num)
+        # (map id, location) of map outputs to fetch, added by the client as the server sends them
+        self.map_outputs = deque()
+        # (map id, output id) of map outputs that could not be fetched, the client reports them
+        self.lost_map_outputs = deque()
+        # Set once every map output is fetched, the server needn't run lost map tasks again for it
+        self.map_outputs_fetched = False
+
+    def add_map_output(self, map_id, location):
+        """
+        Tell the reducer where the output of a map task can be fetched
+        A map task that is run again gets a new location
+        :param map_id:
+        :param location: (host, port, output id)
+        :return:
+        """
+        self.map_outputs.append((map_id, location))
+
+    def read_partition_file(self, file):
+        """
+        Stream the (key, value) pairs of a sorted mapper output file
+        :param file: the open partition file
+        :return: generator of (key, value)
+        """
+        for key, value in read_records(file, on_read=self.add_progress):
+            if (self.slow_mode):
+                time.sleep(0.001)
+            yield key, value
+
+    def add_progress(self, num_bytes):
+        self.progress += num_bytes
+
+    def merge_partition_files(self, paths):
+        """
+        Merge sorted mapper output files into a single sorted run
+        :param paths:
+        :return: path of the run
+        """
+        fs = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        files = [fs.open(path, 'rb', codec=self.codec) for path in paths]
+        path = fs.get_spill_file(self.attempt_id)
+        merged_file = fs.open(path, 'wb', codec=self.codec)
+        writer = RecordWriter(merged_file)
+        for key, value in heapq.merge(*[read_records(f) for f in files], key=lambda pair: pair[0]):
+            writer.write(key, value)
+        writer.flush()
+        fs.close(merged_file)
+
+        for file in files:
+            fs.close(file)
+        return path
 
-        for file_path in files:
-            file = fs.open(file_path, 'r')
-            for line in file:
-                line = line.strip()
-                key, value = line.split('\t')
+    def fetch_partition_files(self):
+        """
+        Fetch this partition's output of every mapper from the shuffle
+        servers of the workers that ran them, several at a time
 
-                if (self.slow_mode):
-                    time.sleep(0.001)
+        The reducer may start before the map phase is over. Mapper output
+        is fetched as the server announces it and merged into runs as it
+        comes in, so only a small merge is left when the last mapper finishes
+        :return: paths of the fetched files and runs, to remove after reading
+        """
+        fs = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        locations = dict()  # map id -> latest location
+        failed = dict()  # map id -> location that could not be fetched
+        fetching = dict()  # future -> (map id, location)
+        fetched = set()
+        pending = []
+        runs = []
+        pool = ThreadPoolExecutor(max_workers=self.parallel_fetches)
+        try:
+            while len(fetched) < self.num_maps and not self.cancelled:
+                while self.map_outputs:
+                    map_id, location = self.map_outputs.popleft()
+                    locations[map_id] = location
 
-                if key in key_vals_map:
-                    key_vals_map[key].append(value)
-                else:
-                    key_vals_map[key] = [value]
+                in_flight = set(map_id for map_id, _ in fetching.values())
+                for map_id, location in locations.items():
+                    if map_id not in fetched and map_id not in in_flight and failed.get(map_id) != location:
+                        future = pool.submit(fetch_map_output, location, self.partition_num,
+                                             fs.get_spill_file(self.attempt_id))
+                        fetching[future] = (map_id, location)
 
-                self.progress += len(line)
+                done = wait(fetching, timeout=FETCH_INTERVAL, return_when=FIRST_COMPLETED)[0] if fetching else []
+                if not fetching:
+                    time.sleep(FETCH_INTERVAL)
+                for future in done:
+                    map_id, location = fetching.pop(future)
+                    try:
+                        pending.append(future.result())
+                        fetched.add(map_id)
+                    except ShuffleFetchError:
+                        # Wait for the server to run the map task again
+                        failed[map_id] = location
+                        self.lost_map_outputs.append((map_id, location[2]))
 
+                if len(pending) >= self.merge_factor:
+                    runs.append(self.merge_partition_files(pending))
+                    for path in pending:
+                        fs.remove(path)
+                    pending = []
+        finally:
+            pool.shutdown(wait=False)
+        return runs + pending
+
+    def reduce_pairs(self, pairs):
+        """
+        Run the user reducer over the values of each key
+        :param pairs: (key, value) sorted by key
+        :return: generator of the reducer's (key, value) output
+        """
         output = []
-        for key, value in sorted(key_vals_map.items(), key=lambda pair: (hashcode(pair[0]) % self.num_workers, pair[0])):
+        for key, key_pairs in groupby(pairs, key=lambda pair: pair[0]):
+            if self.cancelled:
+                break
             if (self.slow_mode):
                 time.sleep(0.001)
             reducer = self.reducer_cls()
-            reducer.reduce(key, value, output)
+            reducer.reduce(key, (value for _, value in key_pairs), output)
             self.progress += len(key)
 
-        output_file = fs.open(fs.get_output_file(self.partition_num), 'w')
-        for key, value in output:
-            output_file.write('%s\t%s\n' % (key, value))
+            yield from output
+            del output[:]
+
+    def merge_previous_output(self, results, previous_file):
+        """
+        Merge this run's output with the last run's output of an incremental job
+        Keys found in both are passed to the user reducer's merge
+        :param results: (key, value) output of this run, sorted by key
+        :param previous_file: the last run's output file for this partition
+        :return: generator of (key, value)
+        """
+        previous = (line.rstrip('\n').split('\t', 1) for line in previous_file)
+        merged = heapq.merge(
+            ((key, value) for key, value in previous),
+            ((str(key), value) for key, value in results),
+            key=lambda pair: pair[0]
+        )
+
+        output = []
+        for key, key_pairs in groupby(merged, key=lambda pair: pair[0]):
+            values = [value for _, value in key_pairs]
+            if len(values) == 1:
+                yield key, values[0]
+                continue
+            reducer = self.reducer_cls()
+            reducer.merge(key, iter(values), output)
+
+            yield from output
+            del output[:]
+
+    def reduce(self):
+        fs = SimpleFileSystem(stage=self.stage, job=self.job_name)
+        paths = self.fetch_partition_files()
+        if self.cancelled:
+            for path in paths:
+                fs.remove(path)
+            return
+        self.map_outputs_fetched = True
+        files = [fs.open(file_path, 'rb', codec=self.codec) for file_path in paths]
+
+        # Mapper output files are already sorted by key, so a k-way merge
+        # yields every key's values contiguously while holding only one
+        # line per file in memory
+        pairs = heapq.merge(*[self.read_partition_file(f) for f in files], key=lambda pair: pair[0])
+
+        results = self.reduce_pairs(pairs)
+        previous_file = None
+        if self.previous_output:
+            previous_file = fs.open(self.previous_output, 'r', codec=get_codec_from_path(self.previous_output))
+            results = self.merge_previous_output(results, previous_file)
+
+        output_file = fs.open(fs.get_output_file(self.partition_num, self.codec, self.attempt_id), 'w', codec=self.codec)
+        for out_key, out_value in results:
+            output_file.write('%s\t%s\n' % (out_key, out_value))
         fs.close(output_file)
 
+        if previous_file:
+            fs.close(previous_file)
+        for file in files:
+            fs.close(file)
+        for path in paths:
+            fs.remove(path)
+
     def run(self):
         self.progress = 0
         self.start_time = time.time()
@@ -8,4 +8,10 @@ class Reducer():
         sum = 0
         for value in values:
             sum += int(value)
-        output.append((key, sum))
\ No newline at end of file
+        output.append((key, sum))
+
+    def merge(self, key, values, output):
+        """
+        Counts from different runs of an incremental job add up
+        """
+        self.reduce(key, values, output)
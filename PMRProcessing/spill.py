@@ -0,0 +1,32 @@
+import heapq
+
+from PMRProcessing.records import RecordWriter, read_records
+
+
+def run_writer(file):
+    """
+    Get a writer for a spill run
+    Records are written with writer.write(key, value, partition_num)
+    :param file: the run file, opened in binary mode
+    :return: RecordWriter
+    """
+    return RecordWriter(file, with_partition=True)
+
+
+def read_run(file):
+    """
+    Stream the records of a spill run in the order they were written
+    :param file: the run file, opened in binary mode
+    :return: generator of (partition, key, value)
+    """
+    return read_records(file, with_partition=True)
+
+
+def merge_runs(files):
+    """
+    Streaming k-way merge of sorted spill runs
+    Only one record per run is held in memory at a time
+    :param files: open run files, each sorted by (partition, key)
+    :return: generator of (partition, key, value) sorted by (partition, key)
+    """
+    return heapq.merge(*[read_run(f) for f in files], key=lambda record: (record[0], record[1]))
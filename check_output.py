@@ -2,15 +2,26 @@ from collections import defaultdict
 from optparse import OptionParser
 import os
 
+from filesystems import SimpleFileSystem, get_codec_from_path
+
 def parse_opts():
         parser = OptionParser()
         parser.add_option('-d', '--datafile', dest='datafile',
                           help='file to check against', type='string', default='right.txt')
+        parser.add_option('-o', '--output', dest='output',
+                          help='output directory of the job, output/job_<n>, the last job\'s by default',
+                          type='string', default=None)
         return parser.parse_args()
 
+def get_last_job_output(base_path='output'):
+        job_dirs = [name for name in os.listdir(base_path)
+                    if name.startswith('job_') and name[len('job_'):].isdigit()]
+        return os.path.join(base_path, max(job_dirs, key=lambda name: int(name[len('job_'):])))
+
 options, args = parse_opts()
+options.output = options.output or get_last_job_output()
 
-print('Checking files in output against benchmark file %s' % options.datafile)
+print('Checking files in %s against benchmark file %s' % (options.output, options.datafile))
 
 right = open(options.datafile,'r')
 outfile = open('compiled_output.txt','w')
@@ -23,8 +34,11 @@ for line in right:
 words_in_benchmark = len(vocabulary.keys())
 
 out_count = 0
-for filename in os.listdir('output'):
-    with open('output/' + filename,'r') as f:
+fs = SimpleFileSystem()
+for filename in sorted(os.listdir(options.output)):
+    if not os.path.isfile(os.path.join(options.output, filename)):
+        continue
+    with fs.open(os.path.join(options.output, filename), 'r', codec=get_codec_from_path(filename)) as f:
         for line in f:
             outfile.write(line)
             out_count += 1
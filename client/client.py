@@ -1,36 +1,83 @@
 import importlib
+import os
 import socket
 import select
+from collections import deque
 from optparse import OptionParser
 import time
 
-from PMRProcessing.mapper.mapper import Mapper
+from PMRProcessing.mapper.mapper import Mapper, SORT_BUFFER_SIZE
+from PMRProcessing.partitioner import HashPartitioner
 from PMRProcessing.reducer.reducer import Reducer
 from connection import PMRConnection
-from filesystems import SimpleFileSystem
+from filesystems import SimpleFileSystem, SplitCache, get_codec_from_path, SPLIT_CACHE_SIZE
 from messages import *
+from shuffle import ShuffleServer
+
+# Map tasks a client takes ahead of the one it runs, their input is
+# received and their module imported while it runs
+PREFETCH_DEPTH = 1
+
+# Messages that assign a task or carry its input, they are taken in the
+# order they arrive, whether a task is running or not
+TASK_INPUT_TYPES = (MessageTypes.TASK_ASSIGN, MessageTypes.DATA_STREAM, MessageTypes.DATA_BLOCK)
 
 
 class Client(object):
     REMOTE_HOST = 'localhost'
     REMOTE_PORT = 8888
 
-    message_write_queue = [
-        SubscribeMessage()
-    ]
     message_read_queue = []
 
     def __init__(self, slow_mode=False):
         options, args = self.parse_opts()
         self.server_address = (options.host, options.port)
+
+        # Reducers fetch the output of this client's map tasks from here
+        self.shuffle_server = ShuffleServer(SimpleFileSystem().get_attempt_partition_file, '', options.shuffle_port)
+        self.shuffle_server.start()
+        self.message_write_queue = [
+            SubscribeMessage(self.shuffle_server.port, options.shuffle_host, not options.legacy_handshake,
+                             0 if options.legacy_handshake else options.prefetch)
+        ]
+        # Attempts whose map output is kept until their job is over, job name -> attempt ids
+        self.map_outputs = dict()
+
         self.has_job = False
         self.instructions_file = None
         self.instructions_type = None
         self.data_path = None
+        self.data_start = 0
+        self.data_end = None
         self.slow_mode = slow_mode
-        self.num_workers = None
+        self.sort_buffer_size = options.sort_buffer
+        self.num_partitions = None
         self.partition_num = None
+        self.codec = None
+        self.attempt_id = None
+        self.num_maps = None
+        self.stage = None
+        self.previous_output = None
+        self.job_name = None
         self.connection = None
+        # TASK_ASSIGN messages of the tasks that haven't started, in the order they run
+        self.task_queue = deque()
+        # Attempts assigned last, an assignment sent again before the server got the ack is ignored
+        self.assigned_attempt_ids = deque(maxlen=64)
+
+        # Inputs received from the server, the current map task's is under data_key
+        self.split_cache = SplitCache(max_size=options.split_cache_size)
+        self.data_key = None
+        # Splits are pinned in the cache from their assignment until their task starts,
+        # by the attempt id or, for a DATAFILE, by datafile_owner. data_pin is the current task's
+        self.data_pin = None
+        self.datafile_owner = 'datafile_{}'.format(os.getpid())
+        # (attempt id, key) of the inputs the server streams, in the order it sends them
+        self.stream_inputs = deque()
+        self.receive_attempt_id = None
+        self.receive_key = None
+        self.data_receive_file = None
+        self.data_remaining = 0
 
     def parse_opts(self):
         parser = OptionParser()
@@ -38,6 +85,24 @@ class Client(object):
                           help='address of server port', type='int', default=self.REMOTE_PORT)
         parser.add_option('-s', '--host', dest='host',
                           help='server host address', type='string', default=self.REMOTE_HOST)
+        parser.add_option('-b', '--sort-buffer', dest='sort_buffer',
+                          help='map output records buffered in memory before spilling to disk',
+                          type='int', default=SORT_BUFFER_SIZE)
+        parser.add_option('--split-cache-size', dest='split_cache_size',
+                          help='bytes of input received from the server kept for later tasks',
+                          type='int', default=SPLIT_CACHE_SIZE)
+        parser.add_option('--shuffle-port', dest='shuffle_port',
+                          help='port reducers fetch map output from, any free one by default',
+                          type='int', default=0)
+        parser.add_option('--shuffle-host', dest='shuffle_host',
+                          help='address reducers reach this client at, the one it connects from by default',
+                          type='string', default=None)
+        parser.add_option('--legacy-handshake', dest='legacy_handshake',
+                          help='take tasks through the step by step handshake instead of one TASK_ASSIGN',
+                          action='store_true', default=False)
+        parser.add_option('--prefetch', dest='prefetch',
+                          help='map tasks taken ahead of the running one',
+                          type='int', default=PREFETCH_DEPTH)
         return parser.parse_args()
 
     def prep_for_new_job(self):
@@ -45,12 +110,22 @@ class Client(object):
         self.instructions_file = None
         self.instructions_type = None
         self.data_path = None
-        self.num_workers = None
+        self.data_start = 0
+        self.data_end = None
+        self.num_partitions = None
         self.partition_num = None
+        self.codec = None
+        self.attempt_id = None
+        self.num_maps = None
+        self.stage = None
+        self.previous_output = None
+        self.job_name = None
+        self.data_key = None
+        self.data_pin = None
 
     def ready_to_start(self):
         if self.instructions_type == 'Mapper':
-            return self.instructions_file and self.data_path
+            return self.instructions_file and self.data_path and self.split_cache.has(self.data_key)
         elif self.instructions_type == 'Reducer':
             return bool(self.instructions_file)
         else:
@@ -65,66 +140,322 @@ class Client(object):
                     self.has_job = True
                     self.message_write_queue.append(JobReadyToReceiveMessage())
 
+            elif message.m_type in TASK_INPUT_TYPES:
+                self.take_task_input(message)
+                self.start_queued_tasks()
+
             elif message.m_type is MessageTypes.JOB_INSTRUCTIONS_FILE:
-                self.instructions_file = JobInstructionsFileMessage.get_path_from_message(message)
-                self.instructions_type = JobInstructionsFileMessage.get_type_from_message(message)
-                self.num_workers = JobInstructionsFileMessage.get_num_workers_from_message(message)
-                self.partition_num = JobInstructionsFileMessage.get_partition_num_from_message(message)
+                self.set_instructions(message)
             elif message.m_type is MessageTypes.DATAFILE:
-                self.data_path = message.get_body()
+                self.set_input(message, DataFileMessage.get_path(message))
+                self.data_pin = self.datafile_owner
             elif message.m_type is MessageTypes.JOB_START:
                 if not self.ready_to_start():
                     return
 
-                # Start job
+                self.message_write_queue.append(JobStartAckMessage())
+                self.start_task()
+
+            elif message.m_type is MessageTypes.JOB_CANCEL:
+                # The attempt finished before the cancel arrived, its map output isn't needed,
+                # or it hasn't started
+                attempt_id = JobCancelMessage.get_attempt_id(message)
+                self.drop_queued_task(attempt_id)
+                self.split_cache.unpin(attempt_id)
+                SimpleFileSystem().discard_attempt(attempt_id)
+                for attempt_ids in self.map_outputs.values():
+                    if attempt_id in attempt_ids:
+                        attempt_ids.remove(attempt_id)
+            elif message.m_type is MessageTypes.RELEASE_MAP_OUTPUTS:
                 fs = SimpleFileSystem()
+                for attempt_id in self.map_outputs.pop(ReleaseMapOutputsMessage.get_job_name(message), []):
+                    fs.discard_attempt(attempt_id)
+
+    def set_instructions(self, message):
+        """
+        :param message: a JOB_INSTRUCTIONS_FILE or TASK_ASSIGN message
+        :return:
+        """
+        self.instructions_file = JobInstructionsFileMessage.get_path_from_message(message)
+        self.instructions_type = JobInstructionsFileMessage.get_type_from_message(message)
+        self.num_partitions = JobInstructionsFileMessage.get_num_partitions_from_message(message)
+        self.partition_num = JobInstructionsFileMessage.get_partition_num_from_message(message)
+        self.codec = JobInstructionsFileMessage.get_codec_from_message(message)
+        self.attempt_id = JobInstructionsFileMessage.get_attempt_id_from_message(message)
+        self.num_maps = JobInstructionsFileMessage.get_num_maps_from_message(message)
+        self.stage = JobInstructionsFileMessage.get_stage_from_message(message)
+        self.previous_output = JobInstructionsFileMessage.get_previous_output_from_message(message)
+        self.job_name = JobInstructionsFileMessage.get_job_name_from_message(message)
+
+    def set_input(self, message, data_path):
+        """
+        :param message: a DATAFILE or TASK_ASSIGN message
+        :param data_path: the input's path in the message
+        :return:
+        """
+        self.data_path = data_path
+        self.data_start = DataFileMessage.get_start(message)
+        self.data_end = DataFileMessage.get_end(message)
+        self.data_key = DataFileMessage.get_cache_key(message)
+
+    def has_input(self, message):
+        """
+        Whether the client holds the input of a DATAFILE or TASK_ASSIGN
+        message, input it doesn't have is streamed by the server
+        :param message:
+        :return: boolean
+        """
+        key = DataFileMessage.get_cache_key(message)
+        return key is None or self.split_cache.has(key)
+
+    def queue_task(self, message):
+        """
+        Keep a TASK_ASSIGN until the tasks before it are done and its
+        input is in. Its module is imported right away
+        :param message:
+        :return:
+        """
+        attempt_id = JobInstructionsFileMessage.get_attempt_id_from_message(message)
+        if attempt_id in self.assigned_attempt_ids:
+            return
+        self.assigned_attempt_ids.append(attempt_id)
+        self.task_queue.append(message)
+        importlib.import_module(JobInstructionsFileMessage.get_path_from_message(message))
+
+    def drop_queued_task(self, attempt_id):
+        """
+        Forget an assigned task that hasn't started
+        :param attempt_id:
+        :return: whether the task was queued
+        """
+        for message in self.task_queue:
+            if JobInstructionsFileMessage.get_attempt_id_from_message(message) == attempt_id:
+                self.task_queue.remove(message)
+                return True
+        return False
+
+    def take_task_input(self, message):
+        """
+        Queue an assigned task or receive the input streamed for one
+        :param message: a TASK_ASSIGN, DATA_STREAM or DATA_BLOCK message
+        :return:
+        """
+        if message.m_type is MessageTypes.TASK_ASSIGN:
+            self.queue_task(message)
+        elif message.m_type is MessageTypes.DATA_STREAM:
+            self.receive_stream(DataStreamMessage.get_size(message))
+        else:
+            self.receive_data(DataBlockMessage.get_data(message))
+
+    def start_queued_tasks(self):
+        """
+        Run the assigned tasks one after the other while the input of
+        the next one is in, the main loop is blocked until they are over
+        :return:
+        """
+        while not self.has_job and self.task_queue and self.has_input(self.task_queue[0]):
+            message = self.task_queue.popleft()
+            self.has_job = True
+            self.set_instructions(message)
+            self.set_input(message, TaskAssignMessage.get_data_path(message))
+            self.data_pin = self.attempt_id
+            self.start_task()
+
+    def send_queued_messages(self):
+        while self.message_write_queue:
+            self.connection.send_message(self.message_write_queue.pop(0))
+        self.connection.write()
+
+    def start_task(self):
+        """
+        Run the task that was set up, the main loop is blocked until it is over
+        :return:
+        """
+        # Queued messages, the start ack among them, go out before the
+        # task blocks the main loop. A reducer is only told where map
+        # output is once the server knows it started
+        self.send_queued_messages()
+
+        # Start job
+        fs = SimpleFileSystem()
+
+        pkg = importlib.import_module(self.instructions_file)
+        instructions_class = getattr(pkg, self.instructions_type)
 
-                pkg = importlib.import_module(self.instructions_file)
-                instructions_class = getattr(pkg, self.instructions_type)
-
-                in_file = None
-                if self.data_path:
-                    in_file = fs.open(self.data_path, 'r')
-
-                if self.instructions_type == 'Mapper':
-                    # pass instruction class to mapper
-                    task = Mapper(self.data_path, instructions_class,
-                                  self.num_workers, in_stream=in_file, slow_mode=self.slow_mode)
-                elif self.instructions_type == 'Reducer':
-                    # pass instruction class to reducer
-                    task = Reducer(instructions_class, self.num_workers, self.partition_num,
-                                   slow_mode=self.slow_mode)
-
-                # beat method will send status reports to the server
-                # on a separate thread to avoid blocking during the
-                # actual map/reduce
-                task.SetBeatMethod(lambda: [
-                    self.connection.send_message(JobHeartbeatMessage(
-                        str(task.progress), 
-                        str(task.progress/(time.time() - task.start_time))
-                    )),
-                    self.connection.write(),
-                    ])
-                # completion actions upon finishing map/reduce steps
-                # this doesn't actually have to be on a different thread 
-                task.SetDieMethod(lambda: [
-                    self.message_write_queue.append(JobDoneMessage()),
-                    self.prep_for_new_job()
-                    ])
-
-                task.run()
-
-                if in_file:
-                    fs.close(in_file)
+        # The split's lines were received into the split cache,
+        # the server's data files aren't read directly
+        in_file = None
+        if self.data_path and get_codec_from_path(self.data_path):
+            # Compressed output of an earlier stage is mapped whole
+            in_file = fs.open(self.split_cache.get_path(self.data_key), 'r',
+                              codec=get_codec_from_path(self.data_path))
+        elif self.data_path:
+            in_file = fs.open_split(self.split_cache.get_path(self.data_key))
+        if self.data_pin:
+            # The open split stays readable if it is evicted
+            self.split_cache.unpin(self.data_pin)
+
+        if self.instructions_type == 'Mapper':
+            # A Combiner and Partitioner are optional and live next to the Mapper
+            combiner_class = getattr(pkg, 'Combiner', None)
+            partitioner_class = getattr(pkg, 'Partitioner', HashPartitioner)
+
+            # pass instruction class to mapper
+            task = Mapper(self.data_path, instructions_class,
+                          self.num_partitions, combiner_cls=combiner_class,
+                          partitioner_cls=partitioner_class,
+                          in_stream=in_file, slow_mode=self.slow_mode,
+                          sort_buffer_size=self.sort_buffer_size, codec=self.codec,
+                          attempt_id=self.attempt_id, stage=self.stage, job_name=self.job_name)
+        elif self.instructions_type == 'Reducer':
+            # pass instruction class to reducer
+            task = Reducer(instructions_class, self.num_partitions, self.partition_num,
+                           slow_mode=self.slow_mode, codec=self.codec, attempt_id=self.attempt_id,
+                           num_maps=self.num_maps, stage=self.stage,
+                           previous_output=self.previous_output, job_name=self.job_name)
+
+        # beat method will send status reports to the server
+        # on a separate thread to avoid blocking during the
+        # actual map/reduce
+        task.SetBeatMethod(lambda: [
+            self.connection.send_message(JobHeartbeatMessage(
+                task.progress,
+                task.progress/(time.time() - task.start_time),
+                task.map_outputs_fetched if isinstance(task, Reducer) else None
+            )),
+            self.send_lost_map_outputs(task),
+            self.check_for_cancel(task),
+            self.send_queued_messages(),
+            ])
+        # completion actions upon finishing map/reduce steps
+        # this doesn't actually have to be on a different thread 
+        task.SetDieMethod(lambda: self.finish_task(task))
+
+        if self.instructions_type == 'Reducer':
+            # Map output the server announced before the reducer started
+            for message in [m for m in self.message_read_queue if m.m_type is MessageTypes.MAP_OUTPUT]:
+                self.message_read_queue.remove(message)
+                self.add_map_output(task, message)
+
+        task.run()
+
+        if in_file:
+            fs.close(in_file)
+
+    def finish_task(self, task):
+        """
+        Report a finished task. The output of a map task stays in its
+        attempt directory, where reducers fetch it, until its job is over
+        :param task: the Mapper or Reducer that stopped
+        :return:
+        """
+        fs = SimpleFileSystem()
+        if task.cancelled:
+            fs.discard_attempt(task.attempt_id)
+        elif isinstance(task, Mapper):
+            self.map_outputs.setdefault(task.job_name, []).append(task.attempt_id)
+            self.message_write_queue.append(JobDoneMessage(task.attempt_id,
+                                                           fs.get_attempt_output_size(task.attempt_id)))
+        else:
+            self.message_write_queue.append(JobDoneMessage(task.attempt_id))
+        self.prep_for_new_job()
+
+    def add_map_output(self, task, message):
+        if MapOutputMessage.get_attempt_id(message) == task.attempt_id:
+            task.add_map_output(MapOutputMessage.get_map_id(message), MapOutputMessage.get_location(message))
+
+    def send_lost_map_outputs(self, task):
+        """
+        Tell the server about map output the running reducer could not fetch
+        :param task:
+        :return:
+        """
+        while isinstance(task, Reducer) and task.lost_map_outputs:
+            map_id, output_id = task.lost_map_outputs.popleft()
+            self.connection.send_message(MapOutputLostMessage(map_id, output_id))
+
+    def receive_stream(self, size):
+        """
+        Start receiving the input the server streams next
+        :param size: bytes of input
+        :return:
+        """
+        self.receive_attempt_id, self.receive_key = self.stream_inputs.popleft()
+        self.data_remaining = size
+        self.data_receive_file = self.split_cache.open_for_write(self.receive_key)
+        self.receive_data(b'')
+
+    def receive_data(self, data):
+        """
+        Write a block of the input being streamed, the server is told
+        once all of it is in the split cache
+        :param data: bytes
+        :return:
+        """
+        self.data_receive_file.write(data)
+        self.data_remaining -= len(data)
+        if not self.data_remaining:
+            self.split_cache.commit(self.data_receive_file, self.receive_key)
+            self.data_receive_file = None
+            self.message_write_queue.append(DataFileAckMessage(attempt_id=self.receive_attempt_id))
+
+    def check_for_cancel(self, task):
+        """
+        Read the messages that arrived while the task runs, the main loop
+        is blocked until it finishes. Cancels the task if the server asks
+        to. Tasks assigned ahead are queued and their input received,
+        anything else is queued for the main loop
+        :param task: the running Mapper or Reducer
+        :return:
+        """
+        # Assignments and input read before the task started come before
+        # what arrives while it runs
+        for message in [m for m in self.message_read_queue if m.m_type in TASK_INPUT_TYPES]:
+            self.message_read_queue.remove(message)
+            self.take_task_input(message)
+
+        readable, _, _ = select.select([self.connection.file_descriptor], [], [], 0)
+        while readable:
+            for message in self.connection.receive():
+                if message.m_type is MessageTypes.JOB_CANCEL:
+                    attempt_id = JobCancelMessage.get_attempt_id(message)
+                    if attempt_id == task.attempt_id:
+                        task.cancel()
+                    elif self.drop_queued_task(attempt_id):
+                        self.split_cache.unpin(attempt_id)
+                    else:
+                        self.message_read_queue.append(message)
+                elif message.m_type is MessageTypes.MAP_OUTPUT:
+                    self.add_map_output(task, message)
+                elif message.m_type in TASK_INPUT_TYPES:
+                    self.send_ack_for(message)
+                    self.take_task_input(message)
+                else:
+                    self.send_ack_for(message)
+                    self.message_read_queue.append(message)
+            readable, _, _ = select.select([self.connection.file_descriptor], [], [], 0)
 
     def send_ack_for(self, message):
         if message.m_type is MessageTypes.JOB_INSTRUCTIONS_FILE:
             self.message_write_queue.append(JobInstructionsFileAckMessage())
         elif message.m_type is MessageTypes.DATAFILE:
-            self.message_write_queue.append(DataFileAckMessage())
-        elif message.m_type is MessageTypes.JOB_START:
-            if self.ready_to_start():
-                self.message_write_queue.append(JobStartAckMessage())
+            if DataFileMessage.get_cache_key(message):
+                self.split_cache.pin(DataFileMessage.get_cache_key(message), self.datafile_owner)
+            has_data = self.has_input(message)
+            if not has_data:
+                self.stream_inputs.append((None, DataFileMessage.get_cache_key(message)))
+            self.message_write_queue.append(DataFileAckMessage(has_data=has_data))
+        elif message.m_type is MessageTypes.TASK_ASSIGN:
+            attempt_id = JobInstructionsFileMessage.get_attempt_id_from_message(message)
+            # Pinned before it is looked up, a split received meanwhile doesn't evict it
+            if DataFileMessage.get_cache_key(message) and attempt_id not in self.assigned_attempt_ids:
+                self.split_cache.pin(DataFileMessage.get_cache_key(message), attempt_id)
+            has_data = self.has_input(message)
+            stream_input = (attempt_id, DataFileMessage.get_cache_key(message))
+            # The server streams the input once, whatever number of times the assignment was sent
+            if not has_data and attempt_id not in self.assigned_attempt_ids and stream_input not in self.stream_inputs:
+                self.stream_inputs.append(stream_input)
+            self.message_write_queue.append(TaskAssignAckMessage(attempt_id, has_data))
 
     def run(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -137,14 +468,15 @@ class Client(object):
         while True:
             self.do_processing()
 
+            # Don't block while messages read during a task still wait
+            timeout = 0 if self.message_read_queue else None
             if self.message_write_queue:
-                readable, writeable, _ = select.select([sock], [sock], [])
+                readable, writeable, _ = select.select([sock], [sock], [], timeout)
             else:
-                readable, _, _ = select.select([sock], [], [])
+                readable, writeable, _ = select.select([sock], [], [], timeout)
 
             if readable:
-                message = self.connection.receive()
-                if message:
+                for message in self.connection.receive():
                     self.send_ack_for(message)
                     self.message_read_queue.append(message)
 
@@ -1,12 +1,69 @@
+import os
+import selectors
+import socket
 import struct
+from collections import deque
+from itertools import islice, takewhile
 
-from messages import HEADER_SIZE, Message, MessageTypes
+from messages import HEADER_FORMAT, HEADER_SIZE, PROTOCOL_VERSION, Message, MessageTypes, pack_header
+
+# Bytes the receive buffer of a connection starts with, it grows to fit larger messages
+RECEIVE_BUFFER_SIZE = 1 << 16
+
+# Bytes waiting to be sent to a connection above which nothing new should
+# be produced for it until it catches up
+WRITE_HIGH_WATER = 1 << 20
+
+# Chunks handed to a single sendmsg call
+CHUNKS_PER_SEND = 64
+
+# Bytes of a file sent per DATA_BLOCK message
+DATA_BLOCK_SIZE = 1 << 20
 
 
 class ClientDisconnectedException(Exception):
     pass
 
 
+class ProtocolVersionException(ClientDisconnectedException):
+    """
+    The other end speaks another version of the protocol, the connection
+    is dropped as if it disconnected
+    """
+    pass
+
+
+class FileRegion(object):
+    """
+    A byte range of a file waiting in a write buffer, it is sent with
+    sendfile so it never passes through Python
+    """
+    def __init__(self, file, offset, count, close_file=False):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.close_file = close_file  # Close the file once the region is sent
+
+    def __len__(self):
+        return self.count
+
+    def send(self, sock):
+        """
+        Send as much of the region as the socket takes
+        :return: bytes sent
+        """
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+        else:
+            self.file.seek(self.offset)
+            sent = sock.send(self.file.read(min(self.count, DATA_BLOCK_SIZE)))
+        if not sent:
+            raise OSError('{} ended before it was sent'.format(self.file.name))
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+
 class PMRConnection(object):
     """
     Represents a connected client
@@ -14,51 +71,109 @@ class PMRConnection(object):
     def __init__(self, file_descriptor, address=None):
         self.file_descriptor = file_descriptor
         self.address = address
+        # Messages are small and answered right away, don't hold them back
+        # waiting for the ack of the previous one
+        self.file_descriptor.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        self.data_bytes_remaining = 0
-        self.header_buffer = []
-        self.receive_buffer = []
+        # Received bytes are decoded from receive_start up to receive_end
+        self.receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.receive_start = 0
+        self.receive_end = 0
 
-        self.write_buffer = []
+        # Chunks waiting to be sent, the first one may be partly sent already
+        self.write_buffer = deque()
+        self.write_buffer_size = 0
+        self.write_high_water = WRITE_HIGH_WATER
 
-    def clear_buffers(self):
-        self.data_bytes_remaining = 0
-        self.header_buffer = []
-        self.receive_buffer = []
+        # Selector the connection is registered with, if it is part of an event loop
+        self.selector = None
 
-    def receive(self):
+    def register(self, selector):
         """
-        Receive a single message
-        Returns the Message object if finished and False if not
-        :param sock:
-        :return: Message if finished, False if not
+        Watch the connection for reads, and for writes while something is
+        waiting to be sent
+        :param selector: selectors.BaseSelector, the connection is the key's data
+        :return:
         """
-        if len(self.header_buffer) < HEADER_SIZE:
-            data = self.file_descriptor.recv(HEADER_SIZE - len(self.header_buffer))
+        self.selector = selector
+        selector.register(self.file_descriptor, self._get_events(), self)
 
-            if not data:
-                raise ClientDisconnectedException()
+    def unregister(self):
+        if self.selector:
+            self.selector.unregister(self.file_descriptor)
+            self.selector = None
 
-            self.header_buffer += data
+    def _get_events(self):
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if self.write_buffer else 0)
 
-            if len(self.header_buffer) == HEADER_SIZE:
-                _, self.data_bytes_remaining = struct.unpack('>Bi', bytes(self.header_buffer))
-        else:
-            data = self.file_descriptor.recv(self.data_bytes_remaining)
+    def _update_events(self):
+        """
+        Called when the write buffer becomes empty or stops being empty,
+        the only times the events watched change
+        :return:
+        """
+        if self.selector:
+            self.selector.modify(self.file_descriptor, self._get_events(), self)
 
-            if not data:
+    def clear_buffers(self):
+        self.receive_start = 0
+        self.receive_end = 0
+
+    def receive(self):
+        """
+        Read what has arrived with a single recv_into and decode every
+        complete message in it. The start of a message that hasn't fully
+        arrived is kept for the next call
+        :return: list of Message, empty if none is complete yet
+        """
+        if self.receive_end == len(self.receive_buffer):
+            self._make_room()
+
+        messages = []
+        with memoryview(self.receive_buffer) as view:
+            received = self.file_descriptor.recv_into(view[self.receive_end:])
+            if not received:
                 raise ClientDisconnectedException()
+            self.receive_end += received
 
-            self.data_bytes_remaining -= len(data)
-            self.receive_buffer += data
+            while self.receive_end - self.receive_start >= HEADER_SIZE:
+                version, m_type, body_size = struct.unpack_from(HEADER_FORMAT, view, self.receive_start)
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolVersionException(version)
+                body_start = self.receive_start + HEADER_SIZE
+                if body_start + body_size > self.receive_end:
+                    break
+                messages.append(Message(MessageTypes(m_type), bytes(view[body_start:body_start + body_size])))
+                self.receive_start = body_start + body_size
 
-        if len(self.header_buffer) == HEADER_SIZE and self.data_bytes_remaining == 0:
-            m_type, _ = struct.unpack('>Bi', bytes(self.header_buffer))
-            message = Message(MessageTypes(m_type), bytes(self.receive_buffer))
+        if self.receive_start == self.receive_end:
             self.clear_buffers()
-            return message
-        else:
-            return False
+        return messages
+
+    def _make_room(self):
+        """
+        Move a partial message at the end of the receive buffer to its
+        front, growing the buffer if the message doesn't fit in it
+        :return:
+        """
+        pending = self.receive_end - self.receive_start
+        if self.receive_start:
+            self.receive_buffer[:pending] = self.receive_buffer[self.receive_start:self.receive_end]
+            self.receive_start, self.receive_end = 0, pending
+        if pending == len(self.receive_buffer):
+            self.receive_buffer.extend(bytes(len(self.receive_buffer)))
+
+    def drop_write_buffer(self):
+        """
+        Forget what is waiting to be sent, once the connection is gone.
+        The files of queued regions are closed
+        :return:
+        """
+        for chunk in self.write_buffer:
+            if isinstance(chunk, FileRegion):
+                chunk.file.close()
+        self.write_buffer.clear()
+        self.write_buffer_size = 0
 
     def needs_write(self):
         """
@@ -67,19 +182,85 @@ class PMRConnection(object):
         """
         return bool(self.write_buffer)
 
+    def is_backed_up(self):
+        """
+        Is more waiting to be sent than the connection's high-water mark?
+        :return: bool
+        """
+        return self.write_buffer_size >= self.write_high_water
+
     def send_message(self, message):
         self._write_to_buffer(message.get_header_for_send())
         if message.has_body():
             self._write_to_buffer(message.get_body_for_send())
 
+    def send_file(self, path, offset, count):
+        """
+        Send a byte range of a file as DATA_BLOCK messages
+        :param path:
+        :param offset: first byte sent
+        :param count: bytes sent
+        :return:
+        """
+        if not count:
+            return
+        file = open(path, 'rb')
+        for block_start in range(offset, offset + count, DATA_BLOCK_SIZE):
+            block_size = min(DATA_BLOCK_SIZE, offset + count - block_start)
+            self._write_to_buffer(pack_header(MessageTypes.DATA_BLOCK, block_size))
+            self._write_to_buffer(FileRegion(file, block_start, block_size,
+                                             close_file=block_start + block_size == offset + count))
+
     def _write_to_buffer(self, buffer):
         """
         Write to connection's buffer to be sent at next opportunity
-        :param buffer:
+        :param buffer: bytes or FileRegion
         :return:
         """
-        self.write_buffer += buffer
+        self.write_buffer.append(buffer)
+        self.write_buffer_size += len(buffer)
+        if len(self.write_buffer) == 1:
+            self._update_events()
 
     def write(self):
-        self.file_descriptor.sendall(bytes(self.write_buffer))
-        self.write_buffer = []
+        """
+        Send as much of the write buffer as the socket takes. A blocking
+        socket sends all of it, a non-blocking one stops when the socket
+        is full and the rest is sent at the next call
+        :return: bytes sent
+        """
+        total_sent = 0
+        while self.write_buffer:
+            head = self.write_buffer[0]
+            try:
+                if isinstance(head, FileRegion):
+                    sent = head.send(self.file_descriptor)
+                elif hasattr(self.file_descriptor, 'sendmsg'):
+                    chunks = islice(self.write_buffer, CHUNKS_PER_SEND)
+                    sent = self.file_descriptor.sendmsg(
+                        list(takewhile(lambda chunk: not isinstance(chunk, FileRegion), chunks)))
+                else:
+                    sent = self.file_descriptor.send(head)
+            except (BlockingIOError, InterruptedError):
+                break
+            total_sent += sent
+            self.write_buffer_size -= sent
+
+            if isinstance(head, FileRegion):
+                if not head.count:
+                    self.write_buffer.popleft()
+                    if head.close_file:
+                        head.file.close()
+                continue
+
+            # Drop the chunks that were sent, keep the unsent end of a partly sent one
+            while sent:
+                chunk = self.write_buffer[0]
+                if sent < len(chunk):
+                    self.write_buffer[0] = memoryview(chunk)[sent:]
+                    break
+                sent -= len(chunk)
+                self.write_buffer.popleft()
+        if total_sent and not self.write_buffer:
+            self._update_events()
+        return total_sent
@@ -1,9 +1,188 @@
+import bz2
+import io
+import json
+import lzma
 import os
 import random
+import shutil
 import string
+import struct
 import pathlib
+import threading
+import zlib
 from abc import ABCMeta, abstractmethod
 
+# Codecs that jobs can use to compress intermediate and output files
+# name -> (compress, decompress)
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+# Uncompressed bytes per compressed block
+COMPRESSION_BLOCK_SIZE = 1 << 18
+
+# Each block is prefixed with its compressed and uncompressed sizes
+BLOCK_HEADER = struct.Struct('>II')
+
+# Bytes of map output kept in the map output cache by default
+MAP_CACHE_SIZE = 1 << 30
+
+# Bytes of input splits a worker keeps after receiving them by default
+SPLIT_CACHE_SIZE = 1 << 30
+
+
+def get_codec_from_path(path):
+    """
+    Get the codec a file was written with from its extension
+    :param path:
+    :return: codec name or None
+    """
+    extension = os.path.splitext(path)[1][1:]
+    return extension if extension in CODECS else None
+
+
+class BlockCompressedFile(io.RawIOBase):
+    """
+    A stream that compresses data in independent blocks of
+    COMPRESSION_BLOCK_SIZE bytes
+
+    Only a single block is held in memory at a time, when reading
+    or writing. Wrap in io.Buffered* and io.TextIOWrapper as needed.
+    """
+    def __init__(self, file, codec, writing):
+        self._file = file
+        self._compress, self._decompress = CODECS[codec]
+        self._writing = writing
+
+        # Uncompressed data of the current block and the read position in it
+        self._block = bytearray() if writing else b''
+        self._position = 0
+
+    def readable(self):
+        return not self._writing
+
+    def writable(self):
+        return self._writing
+
+    def _read_block(self):
+        """
+        Load the next block of the file
+        :return: False at the end of the file
+        """
+        header = self._file.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return False
+        compressed_size, _ = BLOCK_HEADER.unpack(header)
+        self._block = self._decompress(self._file.read(compressed_size))
+        self._position = 0
+        return True
+
+    def readinto(self, b):
+        while self._position >= len(self._block):
+            if not self._read_block():
+                return 0
+        size = min(len(b), len(self._block) - self._position)
+        b[:size] = self._block[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def _write_block(self, data):
+        compressed = self._compress(bytes(data))
+        self._file.write(BLOCK_HEADER.pack(len(compressed), len(data)))
+        self._file.write(compressed)
+
+    def write(self, b):
+        self._block += b
+        while len(self._block) >= COMPRESSION_BLOCK_SIZE:
+            self._write_block(self._block[:COMPRESSION_BLOCK_SIZE])
+            del self._block[:COMPRESSION_BLOCK_SIZE]
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._writing and self._block:
+            self._write_block(self._block)
+        self._block = b''
+        self._file.close()
+        super().close()
+
+
+class InputSplit(object):
+    """
+    The lines of a byte range [start, end) of a text file
+
+    Follows Hadoop's rules at the edges: a line belongs to the split its
+    first byte falls in. So a split skips the partial line it starts in
+    (the previous split reads it) and reads past its end to finish its
+    last line.
+    """
+    def __init__(self, path, start=0, end=None):
+        self._file = open(path, 'rb')
+        self.start = start
+        self.end = end
+        self._lines = self._read_lines()
+
+    def __iter__(self):
+        # Like a file, iterating again continues where the last one stopped
+        return self._lines
+
+    def _read_lines(self):
+        if self.start > 0:
+            # Starting one byte early means a line that begins exactly
+            # at start is kept, only the newline before it is skipped
+            self._file.seek(self.start - 1)
+            position = self.start - 1 + len(self._file.readline())
+        else:
+            self._file.seek(0)
+            position = 0
+
+        while self.end is None or position < self.end:
+            line = self._file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+    def close(self):
+        self._file.close()
+
+
+def get_split_line_range(path, start=0, end=None):
+    """
+    The bytes holding the lines of a split, by the same rules as InputSplit.
+    Mapping them whole gives the same lines as mapping the split
+    :param path:
+    :param start: first byte of the split
+    :param end: byte after the split, None for the end of the file
+    :return: (first byte, byte after the last line)
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        first = 0
+        if start > 0:
+            f.seek(start - 1)
+            first = start - 1 + len(f.readline())
+        last = size
+        if end is not None and end < size:
+            f.seek(end - 1)
+            last = end - 1 + len(f.readline())
+    return first, max(first, last)
+
+
+def is_plain_name(name):
+    """
+    Whether name is a single path component, as attempt ids and map task
+    fingerprints are. Names from peers are checked with this before they
+    are joined into a path so that they can't point outside of it
+    :param name:
+    :return: bool
+    """
+    return bool(name) and name not in (os.curdir, os.pardir) \
+        and os.sep not in name and (os.altsep is None or os.altsep not in name)
+
 
 class BaseFilesystem(metaclass=ABCMeta):
     """
@@ -23,16 +202,21 @@ class BaseFilesystem(metaclass=ABCMeta):
 
 
 class SimpleFileSystem(BaseFilesystem):
-    def __init__(self, fs_base_path='temp', output_base_path='output'):
+    def __init__(self, fs_base_path='temp', output_base_path='output', stage=None, job=None):
+        # Each job, and each stage of a pipeline, keeps its map output apart
+        # from the others, attempts share one directory so they can be found by id alone
+        self._root_path = fs_base_path
         self._fs_base_path = fs_base_path
+        if job:
+            self._fs_base_path = os.path.join(self._fs_base_path, 'jobs', job)
+        if stage:
+            self._fs_base_path = os.path.join(self._fs_base_path, 'stages', stage)
         self._output_base_path = output_base_path
         self._file_name_len = 10
 
-        if not os.path.exists(self._fs_base_path):
-            os.makedirs(self._fs_base_path)
-
-        if not os.path.exists(self._output_base_path):
-            os.makedirs(self._output_base_path)
+        # Workers may create these at the same time
+        os.makedirs(self._fs_base_path, exist_ok=True)
+        os.makedirs(self._output_base_path, exist_ok=True)
 
     def get_writeable_file_path(self):
         f_name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(self._file_name_len))
@@ -41,24 +225,101 @@ class SimpleFileSystem(BaseFilesystem):
     def get_file_with_name(self, name):
         return '{path}.txt'.format(path=os.path.join(self._fs_base_path, name))
 
-    def get_mapper_output_file(self, partition_num):
+    def get_attempt_path(self, attempt_id):
+        """
+        Directory a task attempt writes its files to until it is committed
+        :param attempt_id:
+        :return: path
+        """
+        return os.path.join(self._root_path, 'attempts', attempt_id)
+
+    def get_stage_output_path(self):
+        """
+        Directory the reducers of a stage that feeds later stages write to
+        :return: path
+        """
+        return os.path.join(self._fs_base_path, 'output')
+
+    def get_mapper_output_file(self, partition_num, attempt_id=None):
+        base_path = self.get_attempt_path(attempt_id) if attempt_id else self._fs_base_path
         dir_name = 'partition_{}'.format(partition_num)
         file = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(self._file_name_len))\
-               + '.txt'
+               + '.bin'
 
-        if not os.path.exists(os.path.join(self._fs_base_path, dir_name)):
-            os.makedirs(os.path.join(self._fs_base_path, dir_name))
-        return os.path.join(self._fs_base_path, dir_name, file)
+        if not os.path.exists(os.path.join(base_path, dir_name)):
+            os.makedirs(os.path.join(base_path, dir_name))
+        return os.path.join(base_path, dir_name, file)
 
-    def get_partition_files(self, partition_num):
-        dir_name = 'partition_{}'.format(partition_num)
-        path = os.path.join(self._fs_base_path, dir_name)
-        return [os.path.join(path, f) for f in os.listdir(path)]
+    def get_spill_file(self, attempt_id=None):
+        base_path = self.get_attempt_path(attempt_id) if attempt_id else self._fs_base_path
+        dir_name = 'spills'
+        file = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(self._file_name_len))\
+               + '.bin'
+
+        if not os.path.exists(os.path.join(base_path, dir_name)):
+            os.makedirs(os.path.join(base_path, dir_name))
+        return os.path.join(base_path, dir_name, file)
+
+    def get_attempt_partition_file(self, attempt_id, partition_num):
+        """
+        The output of a finished map attempt for a partition
+        :param attempt_id:
+        :param partition_num:
+        :return: path, None if the attempt has no such output
+        """
+        if not is_plain_name(attempt_id):
+            return None
+        path = os.path.join(self.get_attempt_path(attempt_id), 'partition_{}'.format(partition_num))
+        files = os.listdir(path) if os.path.isdir(path) else []
+        return os.path.join(path, files[0]) if files else None
 
-    def get_output_file(self, partition_num):
+    def get_attempt_output_size(self, attempt_id):
+        """
+        Bytes of output of a finished map attempt, over all partitions
+        :param attempt_id:
+        :return: int
+        """
+        path = self.get_attempt_path(attempt_id)
+        return sum(os.path.getsize(os.path.join(path, name, f))
+                   for name in os.listdir(path) if name.startswith('partition_')
+                   for f in os.listdir(os.path.join(path, name)))
+
+    def get_output_file(self, partition_num, codec=None, attempt_id=None):
         f_name = 'output_part_{}.txt'.format(partition_num)
+        if codec:
+            f_name += '.' + codec
+        if attempt_id:
+            path = self.get_attempt_path(attempt_id)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            return os.path.join(path, f_name)
         return os.path.join(self._output_base_path, f_name)
 
+    def commit_attempt(self, attempt_id):
+        """
+        Move the output file of a finished reduce attempt to the stage's
+        output directory, then remove what is left of the attempt
+        Map attempts are not committed, their output stays on the worker
+        that ran them
+        :param attempt_id:
+        :return:
+        """
+        path = self.get_attempt_path(attempt_id)
+        if not os.path.exists(path):
+            return
+        for name in os.listdir(path):
+            if name.startswith('output_part_'):
+                os.replace(os.path.join(path, name), os.path.join(self._output_base_path, name))
+        self.discard_attempt(attempt_id)
+
+    def discard_attempt(self, attempt_id):
+        """
+        Remove the files of a cancelled or failed attempt
+        :param attempt_id:
+        :return:
+        """
+        shutil.rmtree(self.get_attempt_path(attempt_id), ignore_errors=True)
+
     def _delete_folder(self, path):
         if type(path) is str:
             path = pathlib.Path(path)
@@ -72,8 +333,302 @@ class SimpleFileSystem(BaseFilesystem):
         self._delete_folder(self._fs_base_path)
         self._delete_folder(self._output_base_path)
 
-    def open(self, path, mode):
-        return open(path, mode)
+    def remove_base_directory(self):
+        """
+        Remove the intermediate files of a finished job
+        :return:
+        """
+        shutil.rmtree(self._fs_base_path, ignore_errors=True)
+
+    def remove_output_directory(self):
+        """
+        Remove the output of a job that will not finish
+        :return:
+        """
+        shutil.rmtree(self._output_base_path, ignore_errors=True)
+
+    def open(self, path, mode, codec=None):
+        """
+        Open a file, optionally compressed in blocks with one of CODECS
+        :param path:
+        :param mode: 'r', 'w', 'rb' or 'wb' when a codec is given
+        :param codec: None for a plain file
+        :return: file object
+        """
+        if not codec:
+            return open(path, mode)
+
+        writing = 'w' in mode
+        raw = BlockCompressedFile(open(path, 'wb' if writing else 'rb'), codec, writing)
+        file = io.BufferedWriter(raw) if writing else io.BufferedReader(raw)
+        if 'b' not in mode:
+            file = io.TextIOWrapper(file, encoding='utf-8')
+        return file
+
+    def open_split(self, path, start=0, end=None):
+        """
+        Open the lines of a byte range of a file for reading
+        :param path:
+        :param start: first byte of the split
+        :param end: byte after the split, None for the end of the file
+        :return: InputSplit
+        """
+        return InputSplit(path, start, end)
 
     def close(self, file):
         file.close()
+
+    def remove(self, path):
+        os.remove(path)
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class MapOutputCache(object):
+    """
+    Partition files of finished map tasks, kept across jobs under a
+    fingerprint of the task so the same map over the same input isn't
+    run twice. Reducers fetch cached output from the server's shuffle server
+
+    Lives outside of the temp directory so clean_directories keeps it.
+    The least recently used entries are removed once it holds more than
+    max_size bytes
+    """
+    def __init__(self, base_path='cache', max_size=MAP_CACHE_SIZE):
+        self._base_path = base_path
+        self.max_size = max_size
+        # Entries are stored from other threads
+        self._lock = threading.RLock()
+
+        os.makedirs(self._base_path, exist_ok=True)
+
+    def _get_entry_path(self, fingerprint):
+        return os.path.join(self._base_path, fingerprint)
+
+    def _get_entry_size(self, path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+    def get_partition_file(self, fingerprint, partition_num):
+        """
+        :param fingerprint:
+        :param partition_num:
+        :return: path of a cached map output partition, None if it isn't cached
+        """
+        if not is_plain_name(fingerprint):
+            return None
+        path = os.path.join(self._get_entry_path(fingerprint), 'partition_{}.bin'.format(partition_num))
+        return path if os.path.exists(path) else None
+
+    def restore(self, fingerprint):
+        """
+        Look up the cached output of a map task
+        :param fingerprint:
+        :return: bytes of output cached for the task, None if it isn't cached
+        """
+        with self._lock:
+            path = self._get_entry_path(fingerprint)
+            if not self.max_size or not os.path.exists(path):
+                return None
+            os.utime(path)  # Mark as recently used
+            return self._get_entry_size(path)
+
+    def store(self, fingerprint, num_partitions, fetch):
+        """
+        Keep the output of a finished map task
+        :param fingerprint:
+        :param num_partitions:
+        :param fetch: function (partition_num, path) that copies the task's output of a partition to path
+        :return:
+        """
+        path = self._get_entry_path(fingerprint)
+        if not self.max_size or os.path.exists(path):
+            return
+        # Fill a temporary directory first so a partial entry is never used
+        temp_path = '{}.{}.tmp'.format(path, ''.join(random.choice(string.ascii_lowercase) for _ in range(8)))
+        os.makedirs(temp_path)
+        try:
+            for partition_num in range(num_partitions):
+                fetch(partition_num, os.path.join(temp_path, 'partition_{}.bin'.format(partition_num)))
+        except Exception:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+        with self._lock:
+            if os.path.exists(path):
+                shutil.rmtree(temp_path, ignore_errors=True)
+                return
+            os.replace(temp_path, path)
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_size
+        :return:
+        """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self._base_path):
+                path = os.path.join(self._base_path, name)
+                if not name.endswith('.tmp'):
+                    entries.append((os.path.getmtime(path), self._get_entry_size(path), path))
+            entries.sort()
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total_size -= size
+
+
+class SplitCache(object):
+    """
+    Input splits a worker received from the master, kept under a key of
+    the split so a split mapped again (by a rerun or a backup attempt)
+    isn't sent again
+
+    The least recently used splits are removed once it holds more than
+    max_size bytes. Splits pinned by a task that hasn't started are kept,
+    even if the cache goes over max_size. Pins are files next to the
+    splits so workers sharing the cache directory keep each other's
+    """
+    def __init__(self, base_path='split_cache', max_size=SPLIT_CACHE_SIZE):
+        self._base_path = base_path
+        self.max_size = max_size
+
+        os.makedirs(self._base_path, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self._base_path, key)
+
+    def has(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return False
+        os.utime(path)  # Mark as recently used
+        return True
+
+    def pin(self, key, owner):
+        """
+        Keep a split until owner unpins it. An owner holds one split,
+        the one it pinned before is unpinned
+        :param key:
+        :param owner: a name unique to the task needing the split
+        :return:
+        """
+        self.unpin(owner)
+        open('{}.{}.pin'.format(self.get_path(key), owner), 'wb').close()
+
+    def unpin(self, owner):
+        """
+        :param owner: as given to pin
+        :return:
+        """
+        suffix = '.{}.pin'.format(owner)
+        for name in os.listdir(self._base_path):
+            if name.endswith(suffix):
+                try:
+                    os.remove(os.path.join(self._base_path, name))
+                except FileNotFoundError:
+                    pass
+
+    def open_for_write(self, key):
+        """
+        Open a temporary file to receive a split into, see commit
+        :param key:
+        :return: file object
+        """
+        suffix = ''.join(random.choice(string.ascii_lowercase) for _ in range(8))
+        return open('{}.{}.part'.format(self.get_path(key), suffix), 'wb')
+
+    def commit(self, file, key):
+        """
+        Keep a fully received split. Workers sharing the cache directory
+        may receive the same split, the last one to finish replaces the others'
+        :param file: as returned by open_for_write
+        :param key:
+        :return: path of the split
+        """
+        file.close()
+        os.replace(file.name, self.get_path(key))
+        self.evict()
+        return self.get_path(key)
+
+    def evict(self):
+        """
+        Remove the least recently used splits until the cache fits in
+        max_size, pinned splits are kept
+        :return:
+        """
+        names = os.listdir(self._base_path)
+        pinned = {name.split('.', 1)[0] for name in names if name.endswith('.pin')}
+        entries = []
+        for name in names:
+            path = os.path.join(self._base_path, name)
+            if not name.endswith(('.part', '.pin')):
+                entries.append((os.path.getmtime(path), os.path.getsize(path), name, path))
+        entries.sort()
+
+        total_size = sum(size for _, size, _, _ in entries)
+        for _, size, name, path in entries:
+            if total_size <= self.max_size:
+                break
+            if name in pinned:
+                continue
+            os.remove(path)
+            total_size -= size
+
+
+class IncrementalStore(object):
+    """
+    Where incremental jobs remember how far into their input they got
+    and keep their last output, which the next run merges its own into
+
+    Lives outside of the temp and output directories so clean_directories keeps it
+    """
+    def __init__(self, base_path='incremental'):
+        self._base_path = base_path
+
+        os.makedirs(self._base_path, exist_ok=True)
+
+    def _get_path(self, key):
+        return os.path.join(self._base_path, key)
+
+    def load(self, key):
+        """
+        :param key: identifies the job, see get_incremental_key
+        :return: the state saved by the last run, None if there was none
+        """
+        path = os.path.join(self._get_path(key), 'state.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def get_output_file(self, key, partition_num, codec=None):
+        f_name = 'output_part_{}.txt'.format(partition_num)
+        if codec:
+            f_name += '.' + codec
+        return os.path.join(self._get_path(key), f_name)
+
+    def save(self, key, state, output_files):
+        """
+        Keep the output and state of a finished run
+        :param key:
+        :param state: dict, saved as JSON
+        :param output_files: the run's reducer output files, in partition order
+        :return:
+        """
+        path = self._get_path(key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        for partition_num, output_file in enumerate(output_files):
+            _link_or_copy(output_file, self.get_output_file(key, partition_num, get_codec_from_path(output_file)))
+        # The state goes last, a run that stops half way through saving is not used
+        with open(os.path.join(path, 'state.json'), 'w') as f:
+            json.dump(state, f)
@@ -1,9 +1,24 @@
 import struct
 from enum import Enum
 
-HEADER_FORMAT = '!Bi'
+# Messages are a header of (protocol version, type, body size) then the body
+PROTOCOL_VERSION = 2
+HEADER_FORMAT = '!BBi'
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 
+# Kinds of body fields, the struct format of their value.
+# Strings are sent as their UTF-8 length and bytes
+INT = 'q'
+FLOAT = 'd'
+BOOL = '?'
+STRING = 's'
+
+_FIELD_STRUCTS = {kind: struct.Struct('!' + kind) for kind in (INT, FLOAT, BOOL)}
+_STRING_LENGTH = struct.Struct('!I')
+# Bit i is set when field i of the body is sent, unset fields are None
+_PRESENT_FIELDS = struct.Struct('!Q')
+MAX_FIELDS = _PRESENT_FIELDS.size * 8
+
 
 # Access the value by calling MessageTypes.--type--.value
 # e.g. MessageTypes.SUBSCRIBE_MESSAGE.value
@@ -53,6 +68,34 @@ class MessageTypes(Enum):
     SUBMITTED_JOB_FINISHED = 17  # Server announces completion w/ data path
     SUBMITTED_JOB_FINISHED_ACK = 18  # Commander acks completion
 
+    JOB_CANCEL = 19  # Sent by server to stop an attempt of a task that another attempt finished
+    # [JOB_CANCEL][AttemptID]
+    # No ack, a client that already finished the attempt ignores it
+
+    DATA_STREAM = 20  # Sent by server before the input of a task that the client doesn't have
+    # [DATA_STREAM][Size]
+    DATA_BLOCK = 21  # Sent by server after DATA_STREAM until Size bytes of input were sent
+    # [DATA_BLOCK][Bytes], the body is the raw input
+    # The client sends a DATAFILE_ACK once it has the whole input
+
+    MAP_OUTPUT = 22  # Sent by server to a running reducer for each map task whose output it can fetch
+    # [MAP_OUTPUT][AttemptID][MapID][Host][Port][OutputID]
+    # The reducer fetches the output from the shuffle server at Host:Port
+    MAP_OUTPUT_LOST = 23  # Sent by client when a map output could not be fetched
+    # [MAP_OUTPUT_LOST][MapID][OutputID], the server runs the map task again
+    RELEASE_MAP_OUTPUTS = 24  # Sent by server to every client when a job is over
+    # [RELEASE_MAP_OUTPUTS][JobName], clients remove the job's map output
+
+    TASK_ASSIGN = 25  # Sent by server instead of JOB_READY to clients that subscribed with TaskAssign set
+    # [TASK_ASSIGN][Instructions][Input], the fields of a JOB_INSTRUCTIONS_FILE then of a DATAFILE
+    # The client starts the task as soon as it has the input, there is no JOB_START.
+    # Map tasks may be assigned while the client runs another, up to the
+    # prefetch depth it subscribed with, they run in the order they were sent
+    TASK_ASSIGN_ACK = 26  # Sent by client to ack TASK_ASSIGN
+    # [TASK_ASSIGN_ACK][AttemptID][HasData]
+    # With HasData the task has started, otherwise the server streams the input
+    # and the client sends a DATAFILE_ACK with the AttemptID when it has it
+
     SUBMIT_JOB_DENIED = 97
     # [REASON]
     # Sent from server to commander if the job cannot be executed for REASON
@@ -64,37 +107,127 @@ class MessageTypes(Enum):
     # Additionally specified is the client ID
 
 
+def pack_header(m_type, body_size):
+    return struct.pack(HEADER_FORMAT, PROTOCOL_VERSION, m_type.value, body_size)
+
+
 class Message(object):
+    # (name, kind) of each body field, in the order they are sent.
+    # Fields are only ever added at the end, a receiver reads the ones it
+    # knows and gets None for those a sender left out
+    fields = ()
+
     def __init__(self, m_type, body=None):
         self.m_type = m_type
-        self._body = body  # body must be a string or there will be errors
+        self._body = body  # encoded body, bytes
+        self._fields = None
 
     def __str__(self):
-        return '<Message: type={m_type} body={body}>'.format(m_type=self.m_type, body=self._body)
+        return '<Message: type={m_type} fields={fields}>'.format(m_type=self.m_type, fields=self.get_fields())
 
     def has_body(self):
         return self._body
 
     def get_header_for_send(self):
-        return struct.pack(HEADER_FORMAT, self.m_type.value, len(self._body) if self._body else 0)
+        return pack_header(self.m_type, len(self._body) if self._body else 0)
 
     def get_body_for_send(self):
-        return struct.pack(str(len(self._body)) + 's', bytes(self._body, encoding='utf-8'))
+        return self._body
 
     def is_type(self, m_type):
         return m_type is self.m_type
 
-    def get_body(self):
+    @staticmethod
+    def encode_fields(fields, values):
         """
-        Get body of received message
-        :return:
+        Encode the values of a message's body fields
+        :param fields: (name, kind) of each field
+        :param values: a value or None for each field
+        :return: bytes
         """
-        return str(self._body, encoding='utf-8')
+        present = 0
+        parts = []
+        for index, ((_, kind), value) in enumerate(zip(fields, values)):
+            if value is None:
+                continue
+            present |= 1 << index
+            if kind == STRING:
+                value = value.encode('utf-8')
+                parts.append(_STRING_LENGTH.pack(len(value)))
+                parts.append(value)
+            else:
+                parts.append(_FIELD_STRUCTS[kind].pack(value))
+        return _PRESENT_FIELDS.pack(present) + b''.join(parts)
+
+    def get_fields(self):
+        """
+        The body fields of a received message, decoded on first use
+        :return: dict of field name -> value
+        """
+        if self._fields is None:
+            self._fields = {}
+            fields = MESSAGE_FIELDS.get(self.m_type, ())
+            present, = _PRESENT_FIELDS.unpack_from(self._body, 0) if self._body else (0,)
+            offset = _PRESENT_FIELDS.size
+            for index, (name, kind) in enumerate(fields):
+                if not present & (1 << index):
+                    self._fields[name] = None
+                elif kind == STRING:
+                    length, = _STRING_LENGTH.unpack_from(self._body, offset)
+                    offset += _STRING_LENGTH.size
+                    self._fields[name] = str(self._body[offset:offset + length], encoding='utf-8')
+                    offset += length
+                else:
+                    self._fields[name], = _FIELD_STRUCTS[kind].unpack_from(self._body, offset)
+                    offset += _FIELD_STRUCTS[kind].size
+        return self._fields
+
+    def get_field(self, name):
+        return self.get_fields()[name]
+
+
+class FieldsMessage(Message):
+    """
+    A message whose body is made of the fields listed in its class
+    """
+    m_type = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        assert len(cls.fields) <= MAX_FIELDS, \
+            '{name} has {count} fields, the presence bitmap holds {max}'.format(
+                name=cls.__name__, count=len(cls.fields), max=MAX_FIELDS)
+
+    def __init__(self, *values):
+        super().__init__(self.m_type, Message.encode_fields(self.fields, values))
+
+
+class SubscribeMessage(FieldsMessage):
+    m_type = MessageTypes.SUBSCRIBE_MESSAGE
+    # Where the client's shuffle server listens, the host defaults
+    # to the address the client connected from.
+    # task_assign is set by clients that take a task in one TASK_ASSIGN,
+    # they may also take prefetch map tasks ahead of the one they run
+    fields = (('shuffle_port', INT), ('shuffle_host', STRING), ('task_assign', BOOL), ('prefetch', INT))
+
+    def __init__(self, shuffle_port=None, shuffle_host=None, task_assign=None, prefetch=None):
+        super().__init__(shuffle_port, shuffle_host, task_assign, prefetch)
 
+    @staticmethod
+    def get_shuffle_port(message):
+        return message.get_field('shuffle_port')
 
-class SubscribeMessage(Message):
-    def __init__(self):
-        super().__init__(MessageTypes.SUBSCRIBE_MESSAGE)
+    @staticmethod
+    def get_shuffle_host(message):
+        return message.get_field('shuffle_host')
+
+    @staticmethod
+    def get_task_assign(message):
+        return message.get_field('task_assign') is True
+
+    @staticmethod
+    def get_prefetch(message):
+        return message.get_field('prefetch') or 0
 
 
 class SubscribeAckMessage(Message):
@@ -102,9 +235,12 @@ class SubscribeAckMessage(Message):
         super().__init__(MessageTypes.SUBSCRIBE_ACK_MESSAGE)
 
 
-class JobReadyMessage(Message):
+class JobReadyMessage(FieldsMessage):
+    m_type = MessageTypes.JOB_READY
+    fields = (('job_id', INT),)
+
     def __init__(self, job_id):
-        super().__init__(MessageTypes.JOB_READY, job_id)
+        super().__init__(job_id)
 
 
 class JobReadyToReceiveMessage(Message):
@@ -117,33 +253,65 @@ class JobStartAckMessage(Message):
         super().__init__(MessageTypes.JOB_START_ACK)
 
 
-class JobInstructionsFileMessage(Message):
-    separator = ';;'
-
-    def __init__(self, path, type, num_workers, partition_num):
-        super().__init__(MessageTypes.JOB_INSTRUCTIONS_FILE,
-                         '{path};;{type};;{num_workers};;{partition_num}'.format(
-                             path=path,
-                             type=type,
-                             num_workers=num_workers,
-                             partition_num=partition_num
-                         ))
+class JobInstructionsFileMessage(FieldsMessage):
+    m_type = MessageTypes.JOB_INSTRUCTIONS_FILE
+    fields = (
+        ('path', STRING),
+        ('type', STRING),
+        ('num_partitions', INT),
+        ('partition_num', INT),
+        ('codec', STRING),
+        ('attempt_id', STRING),
+        ('num_maps', INT),
+        ('stage', STRING),
+        ('previous_output', STRING),
+        ('job_name', STRING),
+    )
+
+    def __init__(self, path, type, num_partitions, partition_num, codec=None, attempt_id=None, num_maps=None,
+                 stage=None, previous_output=None, job_name=None):
+        super().__init__(path, type, num_partitions, partition_num, codec, attempt_id, num_maps,
+                         stage, previous_output, job_name)
 
     @staticmethod
     def get_path_from_message(message):
-        return message.get_body().split(JobInstructionsFileMessage.separator)[0]
+        return message.get_field('path')
 
     @staticmethod
     def get_type_from_message(message):
-        return message.get_body().split(JobInstructionsFileMessage.separator)[1]
+        return message.get_field('type')
 
     @staticmethod
-    def get_num_workers_from_message(message):
-        return int(message.get_body().split(JobInstructionsFileMessage.separator)[2])
+    def get_num_partitions_from_message(message):
+        return message.get_field('num_partitions')
 
     @staticmethod
     def get_partition_num_from_message(message):
-        return int(message.get_body().split(JobInstructionsFileMessage.separator)[3])
+        return message.get_field('partition_num')
+
+    @staticmethod
+    def get_codec_from_message(message):
+        return message.get_field('codec')
+
+    @staticmethod
+    def get_attempt_id_from_message(message):
+        return message.get_field('attempt_id')
+
+    @staticmethod
+    def get_num_maps_from_message(message):
+        return message.get_field('num_maps')
+
+    @staticmethod
+    def get_stage_from_message(message):
+        return message.get_field('stage')
+
+    @staticmethod
+    def get_previous_output_from_message(message):
+        return message.get_field('previous_output')
+
+    @staticmethod
+    def get_job_name_from_message(message):
+        return message.get_field('job_name')
 
 
 class JobInstructionsFileAckMessage(Message):
@@ -151,14 +319,68 @@ class JobInstructionsFileAckMessage(Message):
         super().__init__(MessageTypes.JOB_INSTRUCTIONS_FILE_ACK)
 
 
-class DataFileMessage(Message):
-    def __init__(self, path):
-        super().__init__(MessageTypes.DATAFILE, path)
+class DataFileMessage(FieldsMessage):
+    m_type = MessageTypes.DATAFILE
+    fields = (('path', STRING), ('start', INT), ('end', INT), ('cache_key', STRING))
 
+    def __init__(self, path, start=0, end=None, cache_key=None):
+        super().__init__(path, start, end, cache_key)
 
-class DataFileAckMessage(Message):
-    def __init__(self):
-        super().__init__(MessageTypes.DATAFILE_ACK)
+    @staticmethod
+    def get_path(message):
+        return message.get_field('path')
+
+    @staticmethod
+    def get_start(message):
+        return message.get_field('start')
+
+    @staticmethod
+    def get_end(message):
+        return message.get_field('end')
+
+    @staticmethod
+    def get_cache_key(message):
+        return message.get_field('cache_key')
+
+
+class DataFileAckMessage(FieldsMessage):
+    m_type = MessageTypes.DATAFILE_ACK
+    # False when the client needs the input sent over the connection.
+    # The attempt is set once input streamed for a TASK_ASSIGN is in
+    fields = (('has_data', BOOL), ('attempt_id', STRING))
+
+    def __init__(self, has_data=True, attempt_id=None):
+        super().__init__(has_data, attempt_id)
+
+    @staticmethod
+    def get_has_data(message):
+        return message.get_field('has_data') is not False
+
+    @staticmethod
+    def get_attempt_id(message):
+        return message.get_field('attempt_id')
+
+
+class DataStreamMessage(FieldsMessage):
+    m_type = MessageTypes.DATA_STREAM
+    fields = (('size', INT),)
+
+    def __init__(self, size):
+        super().__init__(size)
+
+    @staticmethod
+    def get_size(message):
+        return message.get_field('size')
+
+
+class DataBlockMessage(Message):
+    """
+    A block of raw input, the connection sends blocks straight from the
+    file (see PMRConnection.send_file) so this is only used to read them
+    """
+    @staticmethod
+    def get_data(message):
+        return message.get_body_for_send()
 
 
 class JobStartMessage(Message):
@@ -166,9 +388,21 @@ class JobStartMessage(Message):
         super().__init__(MessageTypes.JOB_START)
 
 
-class JobDoneMessage(Message):
-    def __init__(self):
-        super().__init__(MessageTypes.JOB_DONE)
+class JobDoneMessage(FieldsMessage):
+    m_type = MessageTypes.JOB_DONE
+    # output_size is the bytes of output of a map attempt
+    fields = (('attempt_id', STRING), ('output_size', INT))
+
+    def __init__(self, attempt_id=None, output_size=None):
+        super().__init__(attempt_id, output_size)
+
+    @staticmethod
+    def get_attempt_id(message):
+        return message.get_field('attempt_id')
+
+    @staticmethod
+    def get_output_size(message):
+        return message.get_field('output_size')
 
 
 class JobDoneAckMessage(Message):
@@ -176,26 +410,77 @@ class JobDoneAckMessage(Message):
         super().__init__(MessageTypes.JOB_DONE_ACK)
 
 
-class SubmitJobMessage(Message):
-    separator = ';;'
+class JobCancelMessage(FieldsMessage):
+    m_type = MessageTypes.JOB_CANCEL
+    fields = (('attempt_id', STRING),)
 
-    def __init__(self, mapper_name, reducer_name, data_file_path):
-        super().__init__(
-            MessageTypes.SUBMIT_JOB,
-            body=SubmitJobMessage.separator.join([mapper_name, reducer_name, data_file_path])
-        )
+    def __init__(self, attempt_id):
+        super().__init__(attempt_id)
+
+    @staticmethod
+    def get_attempt_id(message):
+        return message.get_field('attempt_id')
+
+
+class SubmitJobMessage(FieldsMessage):
+    m_type = MessageTypes.SUBMIT_JOB
+    fields = (
+        ('mapper_name', STRING),
+        ('reducer_name', STRING),
+        ('data_file_path', STRING),
+        ('codec', STRING),
+        ('split_size', INT),
+        ('num_reducers', INT),
+        ('reduce_slowstart', FLOAT),
+        ('pipeline', STRING),
+        ('incremental', BOOL),
+        ('priority', INT),
+    )
+
+    def __init__(self, mapper_name, reducer_name, data_file_path, codec=None, split_size=None, num_reducers=None,
+                 reduce_slowstart=None, pipeline=None, incremental=False, priority=0):
+        super().__init__(mapper_name, reducer_name, data_file_path, codec, split_size, num_reducers,
+                         reduce_slowstart, pipeline, incremental, priority)
 
     @staticmethod
     def get_mapper_name(message):
-        return message.get_body().split(SubmitJobMessage.separator)[0]
+        return message.get_field('mapper_name')
 
     @staticmethod
     def get_reducer_name(message):
-        return message.get_body().split(SubmitJobMessage.separator)[1]
+        return message.get_field('reducer_name')
 
     @staticmethod
     def get_data_file_path(message):
-        return message.get_body().split(SubmitJobMessage.separator)[2]
+        return message.get_field('data_file_path')
+
+    @staticmethod
+    def get_codec(message):
+        return message.get_field('codec')
+
+    @staticmethod
+    def get_split_size(message):
+        return message.get_field('split_size')
+
+    @staticmethod
+    def get_num_reducers(message):
+        return message.get_field('num_reducers')
+
+    @staticmethod
+    def get_reduce_slowstart(message):
+        return message.get_field('reduce_slowstart')
+
+    @staticmethod
+    def get_pipeline(message):
+        return message.get_field('pipeline')
+
+    @staticmethod
+    def get_incremental(message):
+        return bool(message.get_field('incremental'))
+
+    @staticmethod
+    def get_priority(message):
+        return message.get_field('priority') or 0
 
 
 class SubmitJobAckMessage(Message):
@@ -203,30 +488,145 @@ class SubmitJobAckMessage(Message):
         super().__init__(MessageTypes.SUBMIT_JOB_ACK)
 
 
-class SubmitJobDeniedMessage(Message):
+class SubmitJobDeniedMessage(FieldsMessage):
+    m_type = MessageTypes.SUBMIT_JOB_DENIED
+    fields = (('reason', STRING),)
+
     def __init__(self, body):
-        super().__init__(MessageTypes.SUBMIT_JOB_DENIED, body)
+        super().__init__(body)
+
+    @staticmethod
+    def get_reason(message):
+        return message.get_field('reason')
 
 
-class SubmittedJobFinishedMessage(Message):
-    def __init__(self):
-        super().__init__(MessageTypes.SUBMITTED_JOB_FINISHED)
+class SubmittedJobFinishedMessage(FieldsMessage):
+    m_type = MessageTypes.SUBMITTED_JOB_FINISHED
+    fields = (('output_path', STRING),)
+
+    def __init__(self, output_path=None):
+        super().__init__(output_path)
+
+    @staticmethod
+    def get_output_path(message):
+        return message.get_field('output_path')
 
 
 class SubmittedJobFinishedAckMessage(Message):
     def __init__(self):
         super().__init__(MessageTypes.SUBMITTED_JOB_FINISHED_ACK)
 
-class JobHeartbeatMessage(Message):
-    separator = ';;'
-    def __init__(self, progress, rate):
-        super().__init__(MessageTypes.JOB_HEARTBEAT, 
-            body=JobHeartbeatMessage.separator.join([progress, rate]))
+
+class JobHeartbeatMessage(FieldsMessage):
+    m_type = MessageTypes.JOB_HEARTBEAT
+    # map_outputs_fetched is set by a reducer that fetched every map output it needs
+    fields = (('progress', INT), ('rate', FLOAT), ('map_outputs_fetched', BOOL))
+
+    def __init__(self, progress, rate, map_outputs_fetched=None):
+        super().__init__(progress, rate, map_outputs_fetched)
 
     @staticmethod
     def get_progress(message):
-        return message.get_body().split(JobHeartbeatMessage.separator)[0]
+        return message.get_field('progress')
 
     @staticmethod
     def get_rate(message):
-        return message.get_body().split(JobHeartbeatMessage.separator)[1]
\ No newline at end of file
+        return message.get_field('rate')
+
+    @staticmethod
+    def get_map_outputs_fetched(message):
+        return bool(message.get_field('map_outputs_fetched'))
+
+
+class MapOutputMessage(FieldsMessage):
+    m_type = MessageTypes.MAP_OUTPUT
+    fields = (('attempt_id', STRING), ('map_id', INT), ('host', STRING), ('port', INT), ('output_id', STRING))
+
+    def __init__(self, attempt_id, map_id, host, port, output_id):
+        super().__init__(attempt_id, map_id, host, port, output_id)
+
+    @staticmethod
+    def get_attempt_id(message):
+        return message.get_field('attempt_id')
+
+    @staticmethod
+    def get_map_id(message):
+        return message.get_field('map_id')
+
+    @staticmethod
+    def get_location(message):
+        """
+        :return: (host, port, output id), as taken by shuffle.fetch_map_output
+        """
+        return message.get_field('host'), message.get_field('port'), message.get_field('output_id')
+
+
+class MapOutputLostMessage(FieldsMessage):
+    m_type = MessageTypes.MAP_OUTPUT_LOST
+    fields = (('map_id', INT), ('output_id', STRING))
+
+    def __init__(self, map_id, output_id):
+        super().__init__(map_id, output_id)
+
+    @staticmethod
+    def get_map_id(message):
+        return message.get_field('map_id')
+
+    @staticmethod
+    def get_output_id(message):
+        return message.get_field('output_id')
+
+
+class ReleaseMapOutputsMessage(FieldsMessage):
+    m_type = MessageTypes.RELEASE_MAP_OUTPUTS
+    fields = (('job_name', STRING),)
+
+    def __init__(self, job_name):
+        super().__init__(job_name)
+
+    @staticmethod
+    def get_job_name(message):
+        return message.get_field('job_name')
+
+
+class TaskAssignMessage(FieldsMessage):
+    m_type = MessageTypes.TASK_ASSIGN
+    # Read with the getters of JobInstructionsFileMessage and DataFileMessage,
+    # except for the input's path which is data_path
+    fields = JobInstructionsFileMessage.fields + (
+        ('data_path', STRING),
+        ('start', INT),
+        ('end', INT),
+        ('cache_key', STRING),
+    )
+
+    def __init__(self, path, type, num_partitions, partition_num, codec=None, attempt_id=None, num_maps=None,
+                 stage=None, previous_output=None, job_name=None, data_path=None, start=0, end=None,
+                 cache_key=None):
+        super().__init__(path, type, num_partitions, partition_num, codec, attempt_id, num_maps,
+                         stage, previous_output, job_name, data_path, start, end, cache_key)
+
+    @staticmethod
+    def get_data_path(message):
+        return message.get_field('data_path')
+
+
+class TaskAssignAckMessage(FieldsMessage):
+    m_type = MessageTypes.TASK_ASSIGN_ACK
+    # has_data is False when the client needs the input sent over the connection
+    fields = (('attempt_id', STRING), ('has_data', BOOL))
+
+    def __init__(self, attempt_id=None, has_data=True):
+        super().__init__(attempt_id, has_data)
+
+    @staticmethod
+    def get_attempt_id(message):
+        return message.get_field('attempt_id')
+
+    @staticmethod
+    def get_has_data(message):
+        return message.get_field('has_data') is not False
+
+
+# Body fields of each message type, to decode received messages
+MESSAGE_FIELDS = {cls.m_type: cls.fields for cls in FieldsMessage.__subclasses__()}
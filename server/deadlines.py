@@ -0,0 +1,45 @@
+import heapq
+import time
+from itertools import count
+
+
+class DeadlineQueue(object):
+    """
+    Functions to call at given times, kept in a heap so that only the
+    ones whose time has come are looked at
+    """
+    def __init__(self):
+        # (time, sequence number, function), the soonest first
+        self._heap = []
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, deadline, function):
+        """
+        :param deadline: time.time() at which to call function
+        :param function: called with the current time
+        :return:
+        """
+        heapq.heappush(self._heap, (deadline, next(self._sequence), function))
+
+    def next_deadline(self):
+        """
+        :return: the soonest deadline, None if there is none
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def run_expired(self, now=None):
+        """
+        Call the functions whose deadline has passed, soonest first
+        :param now: the current time
+        :return: the number of functions called
+        """
+        now = time.time() if now is None else now
+        num_called = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, _, function = heapq.heappop(self._heap)
+            function(now)
+            num_called += 1
+        return num_called
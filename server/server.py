@@ -1,29 +1,40 @@
 import importlib
 import curses
 import socket
-import select
+import selectors
 import random
 import string
 import os
+import threading
 from optparse import OptionParser
-from datetime import datetime, timedelta
 
-from PMRJob.job import setup_mapping_tasks, setup_reducing_tasks
+from PMRJob.job import Job, setup_mapping_tasks, get_default_split_size, get_map_task_fingerprint, get_split_cache_key,\
+    get_incremental_key, get_input_checksum, get_last_line_end, REDUCE_SLOWSTART
+from PMRJob.pipeline import Stage, load_pipeline, check_pipeline, set_output_paths
 from connection import ClientDisconnectedException
-from filesystems import SimpleFileSystem
+from filesystems import SimpleFileSystem, MapOutputCache, IncrementalStore, get_split_line_range, CODECS
 from messages import *
+from shuffle import ShuffleServer, ShuffleFetchError, fetch_map_output
 from .server_connections import WorkerConnection, ConnectionsList
+from .deadlines import DeadlineQueue
 
 from PMRProcessing.heartbeat.heartbeat import *
 
 # Timeout before resending messages
 PROTOCOL_TIMEOUT_SECONDS = 3
 
+# Longest wait for events, jobs are checked on at least this often
+LOOP_INTERVAL_SECONDS = 1.0
+
+# Seconds between looks for stragglers and tasks taken ahead while jobs run
+PERFORMANCE_CHECK_SECONDS = 1.0
+
 
 class Server(object):
     _PORT = '8888'
     _HOST = 'localhost'
     job_id = 0  # Track job_ids so as not to reuse them
+    submitted_job_id = 0  # Likewise for submitted jobs
 
     def __init__(self):
         options, args = self.parse_opts()
@@ -33,24 +44,27 @@ class Server(object):
         self.sock.setblocking(1)
         self.sock.settimeout(1.0)
         self.sock.bind(self.server_address)
-        self.sock.listen(10)  # Backlog of 10
+        self.sock.listen(socket.SOMAXCONN)  # Many workers may connect at once
 
         self.running = True
-        self.connections_list = ConnectionsList()
-
-        # job related stats
-        self.job_started = False
-        self.mapping = False
-        self.reducing = False
-        self.mapper_name = None
-        self.reducer_name = None
-
-        # number of connected workers
-        self.num_workers = 0
-
-        self.job_submitter_connection = None  # The conn that submitted the current job
-        self.sub_jobs = list()  # Jobs to be executed at next opportunity
-        self.pending_jobs = list()  # Jobs that are blocked by something in sub_jobs
+        # Watches the listening socket and every connection, epoll where there is one
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.connections_list = ConnectionsList(self.selector)
+
+        # Submitted jobs that are running, in the order they were submitted
+        # Their tasks share the workers
+        self.jobs = list()
+
+        # output of map tasks kept across jobs
+        self.map_cache = MapOutputCache(max_size=options.cache_size)
+        # reducers fetch cached map output from here
+        self.shuffle_server = ShuffleServer(self.map_cache.get_partition_file, options.host, options.shuffle_port)
+        self.shuffle_server.start()
+        # Where reducers on other machines reach it, not the address it is bound to
+        self.shuffle_address = (self.get_shuffle_host(options), self.shuffle_server.port)
+        # input offsets and output of incremental jobs
+        self.incremental_store = IncrementalStore()
 
         self.show_info_pane = options.info is None  # Would be False for no
         if self.show_info_pane:
@@ -63,8 +77,12 @@ class Server(object):
         # max time allowed in between heartbeats of running workers
         # before the worker is assumed dead
         self.timeout_allowance = 5
-        # buffer to avoid unnecessary slowdown in performance when determining
-        # whether to boot an underperforming worker
+        # When to check on heartbeats and acks, so an idle loop doesn't walk every connection
+        self.deadlines = DeadlineQueue()
+        # Whether performance_check is due on self.deadlines
+        self.watching_performance = False
+        # seconds a backup attempt must be expected to save before it is
+        # started for an underperforming worker's task
         self.time_buffer = 5
 
         # A record of booted worker ids and reasons
@@ -97,8 +115,30 @@ class Server(object):
                           help='don\'t show the informational pane (useful for printing)', action='store_false')
         parser.add_option('--slow', dest='slow',
                           help='slow down event loop for testing', action='store_true')
+        parser.add_option('--cache-size', dest='cache_size',
+                          help='bytes of map output cached across jobs, off by default',
+                          type='int', default=0)
+        parser.add_option('--shuffle-port', dest='shuffle_port',
+                          help='port reducers fetch cached map output from, any free one by default',
+                          type='int', default=0)
+        parser.add_option('--shuffle-host', dest='shuffle_host',
+                          help='address reducers fetch cached map output from, the bind host or, '
+                               'if it is a wildcard, this machine\'s name by default',
+                          type='string', default=None)
         return parser.parse_args()
 
+    @staticmethod
+    def get_shuffle_host(options):
+        """
+        :param options: as returned by parse_opts
+        :return: the host advertised to reducers for cached map output
+        """
+        if options.shuffle_host:
+            return options.shuffle_host
+        if options.host in ('', '0.0.0.0', '::'):
+            return socket.getfqdn()
+        return options.host
+
     def start(self):
         """
         Start the server by reading in information
@@ -117,102 +157,354 @@ class Server(object):
             conn = self.connections_list.pop()
             conn.file_descriptor.shutdown(socket.SHUT_RDWR)
             conn.file_descriptor.close()
+        self.selector.close()
         self.sock.close()
+        self.shuffle_server.stop()
 
     def update_job_distribution(self):
         """
-        Move pending jobs that are ready to the sub_jobs queue for execution
-        Assign jobs in sub_jobs to clients
+        Create the tasks of each job as their input becomes ready
+        Assign waiting tasks to clients
         :return:
         """
-        self.update_client_performance_statistics()
-        remaining_map_jobs = [j for j in self.sub_jobs if j.instruction_type == 'Mapper' and not j.done]
-
-        if self.mapping and not remaining_map_jobs:
-            self.mapping = False
-            self.reducing = True
-            self.reset_performance_stats()
-            setup_reducing_tasks(self.reducer_name, self.num_workers, self.sub_jobs, self.get_next_job_id)
-
-        # Find clients that can do the job for us
-        # Aka clients who are subscribed and don't have a job id
-        conns = [c for c in self.connections_list.connections if c.subscribed and c.current_job is None]
-
-        for index, job in enumerate(self.sub_jobs):
-            if job.client is None and conns:
-                conn = conns.pop()
+        for submitted_job in self.jobs:
+            if submitted_job.update_stages(self.get_next_job_id):
+                self.reset_performance_stats()
+                # Reducers started before the map phase ended were given an estimate
+                for job in submitted_job.sub_jobs.get_running('Reducer'):
+                    for conn in job.attempts.values():
+                        conn.chunk_size = self.get_chunk_size(job)
+
+        # A task that lost its worker must not wait behind reducers that are
+        # waiting for map output, so they give their workers back
+        num_unassigned = sum(submitted_job.num_unassigned_tasks() for submitted_job in self.jobs)
+        num_idle = self.connections_list.num_idle()
+        if num_unassigned > num_idle:
+            waiting_reducers = [c for submitted_job in self.jobs
+                                for job in submitted_job.get_running_waiting_reducers()
+                                for c in job.attempts.values() if c.running and c.current_job is job]
+            for conn in waiting_reducers[:num_unassigned - num_idle]:
+                self.cancel_attempt(conn)
+
+        # Tasks wait in their job until a worker is idle, so workers that finish
+        # early or join late keep pulling tasks until none are left.
+        # The fastest idle worker pulls the next task
+        # Reducers waiting for map output go last
+        for waiting_reducers in (False, True):
+            while self.connections_list.num_idle():
+                job = self.get_next_task(waiting_reducers)
+                if job is None:
+                    break
+                conn = self.connections_list.pop_idle()
+                if conn is None:
+                    break
                 self.assign_job(conn, job)
 
+        # Map tasks left go ahead of time to workers running a map task, up to
+        # the depth they asked for, so they start them as soon as they're done
+        for conn in self.connections_list.get_prefetching():
+            while len(conn.prefetched_tasks) < conn.prefetch:
+                job = self.get_next_task(maps_only=True)
+                if job is None:
+                    return
+                self.prefetch_job(conn, job)
 
-    def assign_job(self, conn, job):
+    def get_next_task(self, waiting_reducers=False, maps_only=False):
+        """
+        Pick the task the next idle worker runs. Jobs with a higher
+        priority go first, jobs of the same priority share the workers:
+        the one running the fewest tasks gets the worker, then the oldest
+        :param waiting_reducers: pick among reducers waiting for map output
+        :param maps_only: pick among map tasks
+        :return: SubJob or None
+        """
+        candidates = []
+        for submitted_job in self.jobs:
+            job = submitted_job.get_next_task(waiting_reducers, maps_only)
+            if job:
+                candidates.append(((-submitted_job.priority, submitted_job.num_running_tasks(), submitted_job.id), job))
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+
+    def get_job(self, name):
+        for submitted_job in self.jobs:
+            if submitted_job.name == name:
+                return submitted_job
+        return None
+
+    def get_job_by_submitter(self, conn):
+        for submitted_job in self.jobs:
+            if submitted_job.submitter is conn and submitted_job.finished():
+                return submitted_job
+        return None
+
+    def is_waiting_reducer(self, job):
+        return self.get_job(job.job_name).is_waiting_reducer(job)
+
+    def get_chunk_size(self, job):
         # hacky workaround because mapper reads file from data_path and reducer
-        # reads files (plural) from a partition directory
+        # fetches its partition of every map output, assumed to be evenly split
         if (job.data_path is None):
-            conn.chunk_size = sum([os.path.getsize(file) for file in SimpleFileSystem().get_partition_files(job.partition_num)])
+            # Maps still running count for the average of those that are done
+            stage = self.get_job(job.job_name).get_stage(job.stage)
+            output_sizes = [j.output_size for j in stage.map_jobs if j.done]
+            if not output_sizes:
+                return 0
+            return sum(output_sizes) * stage.num_maps // len(output_sizes) // stage.num_reducers
+        elif job.data_end is None:
+            return os.path.getsize(job.data_path)
+        return job.data_end - job.data_start
+
+    def assign_job(self, conn, job):
+        conn.chunk_size = self.get_chunk_size(job)
+        job.pre_execute()
+        conn.attempt_id = job.add_attempt(conn)
+        job.pending_assignment = True
+        conn.current_job = job
+        if conn.task_assign:
+            # Everything the task needs in one message, acked once
+            self.expect_ack(conn, TaskAssignAckMessage)
+            conn.send_message(self.get_task_assign_message(job, conn.attempt_id))
         else:
-            conn.chunk_size = os.path.getsize(job.data_path)
+            conn.send_message(JobReadyMessage(job.id))
 
+    def prefetch_job(self, conn, job):
+        """
+        Assign a map task to a client that runs it after its current
+        tasks, its input is sent while they run
+        :param conn:
+        :param job:
+        :return:
+        """
         job.pre_execute()
-        job.client = conn
+        attempt_id = job.add_attempt(conn)
         job.pending_assignment = True
+        # [job, attempt_id, has_input], has_input is None until the client acks
+        conn.prefetched_tasks.append([job, attempt_id, None])
+        conn.update_state()
+        self.expect_ack(conn, TaskAssignAckMessage)
+        conn.send_message(self.get_task_assign_message(job, attempt_id))
+
+    def start_prefetched_task(self, conn):
+        """
+        A client that finished or dropped its task goes on with the next
+        task it took ahead, once that task's input is in
+        :param conn:
+        :return: Message list to write to worker
+        """
+        if not conn.prefetched_tasks:
+            return []
+        job, attempt_id, has_input = conn.prefetched_tasks.popleft()
         conn.current_job = job
-        conn.send_message(JobReadyMessage(str(job.id)))
+        conn.attempt_id = attempt_id
+        conn.data_file = job.data_path
+        conn.chunk_size = self.get_chunk_size(job)
+        if has_input:
+            return self.start_attempt(conn)
+        return []
+
+    def initialize_job(self, submitter, stages, data_file_path, codec=None, split_size=None,
+                       num_reducers=None, reduce_slowstart=None, incremental=False, priority=0):
+        """
 
-    # sort clients by their estimated processing rate
-    def update_client_performance_statistics(self):
-        if (self.job_started):
-            self.connections_list.sort(key_func=lambda conn: conn.byte_processing_rate, reverse_opt=True)
+        :return: the new Job
+        """
+        self.submitted_job_id += 1
+        submitted_job = Job(self.submitted_job_id, submitter, stages, data_file_path, codec,
+                            REDUCE_SLOWSTART if reduce_slowstart is None else reduce_slowstart, priority)
+
+        start, end = 0, None
+        if incremental:
+            start, end, num_reducers = self.setup_incremental_run(submitted_job, data_file_path, num_reducers)
+
+        # Split and reducer counts are independent of the number of workers,
+        # by default each worker gets a few splits and one reducer
+        num_workers = self.get_num_subscribed_workers()
+        split_size = split_size or get_default_split_size(data_file_path, num_workers, start, end)
+        for stage in stages:
+            stage.num_reducers = stage.num_reducers or num_reducers or num_workers
+            # A stage reading earlier stages maps each of their output partitions
+            stage.num_maps = sum(submitted_job.get_stage(name).num_reducers for name in stage.inputs)
+
+        # monitor utilization of worker resources while jobs run
+        if not self.jobs:
+            self.begin_monitor_job_efficiency()
+        self.jobs.append(submitted_job)
+        if not self.watching_performance:
+            self.watch_performance()
+
+        submitted_job.get_filesystem().clean_directories()
+        set_output_paths(stages, submitted_job.output_path)
+        for stage in stages:
+            if not stage.inputs:
+                setup_mapping_tasks(data_file_path, stage, split_size, submitted_job.sub_jobs, self.get_next_job_id,
+                                    start, end)
+                self.restore_cached_map_tasks(stage, codec)
+        return submitted_job
+
+    def setup_incremental_run(self, submitted_job, data_file_path, num_reducers):
+        """
+        Find where the last run of an incremental job stopped. If the input
+        has only been appended to since, and the run used the same reducer
+        count and codec, only the new lines are mapped and the reducers merge
+        their output with the last run's
+        :param submitted_job: a job with a single stage
+        :param data_file_path:
+        :param num_reducers: requested reducer count, None to keep the last run's
+        :return: (start, end, num_reducers) of the input to map
+        """
+        stage = submitted_job.stages[0]
+        codec = submitted_job.codec
+        key = get_incremental_key(data_file_path, stage.mapper, stage.reducer)
+        state = self.incremental_store.load(key)
+        start = 0
+        end = get_last_line_end(data_file_path)
+
+        if (state and num_reducers in (None, state['num_reducers']) and state['codec'] == codec and
+                state['offset'] <= end and get_input_checksum(data_file_path, state['offset']) == state['checksum']):
+            start = state['offset']
+            num_reducers = state['num_reducers']
+            stage.previous_outputs = [self.incremental_store.get_output_file(key, i, codec)
+                                      for i in range(num_reducers)]
+
+        submitted_job.incremental_run = (key, {
+            'offset': end,
+            'checksum': get_input_checksum(data_file_path, end),
+            'num_reducers': num_reducers or self.get_num_subscribed_workers(),
+            'codec': codec
+        })
+        return start, end, num_reducers
+
+    def save_incremental_run(self, submitted_job):
+        """
+        Keep the output of a finished incremental job for its next run
+        :return:
+        """
+        key, state = submitted_job.incremental_run
+        fs = submitted_job.stages[0].get_filesystem()
+        self.incremental_store.save(key, state, [fs.get_output_file(i, submitted_job.codec)
+                                                 for i in range(state['num_reducers'])])
 
-    def initialize_job(self, submitter, mapper_name, reducer_name, data_file_path):
+    def restore_cached_map_tasks(self, stage, codec=None):
         """
+        Mark the map tasks of a stage whose output is cached from an
+        earlier job as done, they are never sent to a worker. Reducers
+        fetch their output from the server's shuffle server
+        :param stage:
+        :param codec: the job's codec
+        :return:
+        """
+        if not self.map_cache.max_size:
+            return
+        for job in stage.map_jobs:
+            job.fingerprint = get_map_task_fingerprint(job, codec)
+            size = self.map_cache.restore(job.fingerprint)
+            if size is not None:
+                job.map_output = self.shuffle_address + (job.fingerprint,)
+                job.output_size = size
+                job.post_execute(None)
+
+    def cache_map_output(self, job):
+        """
+        Copy the output of a finished map task into the map output cache,
+        on another thread as it is fetched from the worker that ran it
+        :param job: a map SubJob with a fingerprint
+        :return:
+        """
+        fingerprint, num_partitions, location = job.fingerprint, job.num_partitions, job.map_output
+
+        def store():
+            try:
+                self.map_cache.store(fingerprint, num_partitions,
+                                     lambda partition_num, path: fetch_map_output(location, partition_num, path))
+            except ShuffleFetchError:
+                pass  # The worker is gone, the output isn't cached
 
+        threading.Thread(target=store, daemon=True).start()
+
+    def get_map_output_message(self, attempt_id, job):
+        return MapOutputMessage(attempt_id, job.id, *job.map_output)
+
+    def announce_map_output(self, job):
+        """
+        Tell the running reducers of a map task's stage where its output is
+        :param job: a finished map SubJob
         :return:
         """
-        self.job_submitter_connection = submitter
-        self.job_started = True
-        self.mapping = True
-        self.reducing = False
-        self.mapper_name = mapper_name
-        self.reducer_name = reducer_name
-        # equal partitions distributed based off number of workers
-        self.num_workers = self.get_num_subscribed_workers()
-        
-        # monitor utilization of worker resources during job
-        self.begin_monitor_job_efficiency()
-
-        SimpleFileSystem().clean_directories()
-        setup_mapping_tasks(data_file_path, mapper_name, self.num_workers, self.sub_jobs, self.get_next_job_id)
+        for conn in self.connections_list.connections:
+            reducer = conn.current_job
+            if (conn.running and reducer and reducer.instruction_type == 'Reducer' and
+                    reducer.job_name == job.job_name and reducer.stage == job.stage):
+                conn.send_message(self.get_map_output_message(conn.attempt_id, job))
 
-    def get_num_subscribed_workers(self):
-        return len([c for c in self.connections_list.connections if c.subscribed])
+    def rerun_map_task(self, stage, job):
+        """
+        Run a finished map task again, its output can't be fetched anymore
+        Reducers of the stage wait for it like for any other map task
+        :param stage:
+        :param job:
+        :return:
+        """
+        job.reset()
+        stage.maps_done = False
 
-    def job_finished(self):
+    def needs_map_output(self, stage):
         """
-        Return whether the job is finished
-        Aka is it in reducing mode w/ all jobs completed
-        :return:s
+        Whether a reducer of the stage may still fetch map output. A reducer
+        is done with it once an attempt says it fetched all of it, a backup
+        attempt that can't fetch it reports the output lost
+        :param stage:
+        :return: bool
         """
-        if self.reducing:
-            remaining_jobs = [j for j in self.sub_jobs if not j.done]
-            return not remaining_jobs
+        if not stage.reduce_jobs:
+            return True
+        for reducer in stage.reduce_jobs:
+            if not reducer.done and not any(conn.map_outputs_fetched and conn.current_job is reducer
+                                            for conn in reducer.attempts.values()):
+                return True
         return False
 
-    def mark_job_as_finished(self):
+    def rerun_lost_map_tasks(self, conn):
+        """
+        Run the map tasks whose output was on a worker that is gone again,
+        unless the reducers of their stage are all done with it
+        :param conn:
+        :return:
+        """
+        for submitted_job in self.jobs:
+            for stage in submitted_job.stages:
+                if not self.needs_map_output(stage):
+                    continue
+                for job in stage.map_jobs:
+                    if job.done and job.map_output and job.map_output[:2] == conn.shuffle_address:
+                        self.rerun_map_task(stage, job)
+
+    def get_num_subscribed_workers(self):
+        return len([c for c in self.connections_list.connections if c.subscribed])
+
+    def mark_job_as_finished(self, submitted_job):
         """
-        Prep server for new job
-        Called when commander acks the job completion
+        Drop a job and its intermediate files
+        Called when commander acks the job completion, or is gone
         :return:
         """
-        self.job_started = False
-        self.mapping = False
-        self.reducing = False
-        self.mapper_name = None
-        self.reducer_name = None
-        self.job_submitter_connection = None
-        self.sub_jobs = []
-        # self.num_workers = 0
-        self.end_monitor_job_efficiency()
-        self.reset_performance_stats()
+        # Attempts left are cancelled: map tasks run again after the reducers
+        # were done with their output, or any task of a job nobody waits for
+        for conn in self.connections_list.connections:
+            for prefetched_task in [t for t in conn.prefetched_tasks if t[0].job_name == submitted_job.name]:
+                self.cancel_prefetched_task(conn, prefetched_task)
+            if conn.current_job and conn.current_job.job_name == submitted_job.name:
+                self.cancel_attempt(conn)
+        self.jobs.remove(submitted_job)
+        submitted_job.get_filesystem().remove_base_directory()
+        # Workers keep the output of the job's map tasks until now
+        for conn in self.connections_list.connections:
+            if conn.subscribed:
+                conn.send_message(ReleaseMapOutputsMessage(submitted_job.name))
+        if not self.jobs:
+            self.end_monitor_job_efficiency()
+            self.reset_performance_stats()
 
     def get_progress_bar(self, iteration, total, prefix = '', suffix = '', decimals = 1, barLength = 100):
         # Adapted from: http://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
@@ -249,11 +541,14 @@ class Server(object):
                 self.stdscr.addstr(line_number, 0, line)
 
         line_number += 2
-        if self.job_started:
-            total_tasks = len(self.sub_jobs) + len(self.pending_jobs)
-            tasks_complete = len([j for j in self.sub_jobs + self.pending_jobs if j.client])
-            percent = round(tasks_complete / total_tasks * 100)
-            self.stdscr.addstr(line_number, 0, 'Running job...')
+        if self.jobs:
+            self.stdscr.addstr(line_number, 0, 'Running {} job{}...'.format(len(self.jobs),
+                                                                            '' if len(self.jobs) == 1 else 's'))
+            for submitted_job in self.jobs:
+                line_number += 1
+                self.stdscr.addstr(line_number, 0, '{} (priority {}): {}/{} tasks done'.format(
+                    submitted_job.name, submitted_job.priority, submitted_job.sub_jobs.num_done,
+                    len(submitted_job.sub_jobs)))
         else:
             self.stdscr.addstr(line_number, 0, 'Waiting for job...')
 
@@ -273,8 +568,9 @@ class Server(object):
         The server main loop
 
         For each loop, call do_processing to do any extraneous processing
-        Then block on select(..) and read/write from clients, handling any
-        messages that they send
+        Then wait on the selector and read/write from clients, handling any
+        messages that they send. Clients are watched for writes only while
+        something is waiting to be sent to them
 
         :param mapper_name:
         :param reducer_name:
@@ -286,98 +582,201 @@ class Server(object):
                 time.sleep(.5)
             if self.show_info_pane:
                 self.update_interface()
-            read_list = [self.sock]
-            read_list += self.connections_list.get_read_set()
-            write_list = self.connections_list.get_write_set()
 
-            readable, writeable, _ = select.select(read_list, write_list, [], 1.0)
-            for s in readable:
-                if s == self.sock:
+            events = self.selector.select(self.get_select_timeout())
+            for key, mask in events:
+                if key.fileobj is self.sock:
                     try:
                         connection, client_address = self.sock.accept()
                         connection.setblocking(0)
 
-                        self.connections_list.add(WorkerConnection(connection, client_address))
+                        conn = WorkerConnection(connection, client_address)
+                        self.connections_list.add(conn)
                     except:
                         pass
-                else:
-                    conn = self.connections_list.get_by_socket(s)
+                elif mask & selectors.EVENT_READ:
+                    conn = self.connections_list.get_by_socket(key.fileobj)
+                    if conn is None:
+                        # Dropped while handling an earlier event
+                        continue
                     try:
-                        message = conn.receive()
-                        if message:
+                        # Every message that arrived is handled before tasks are reassigned
+                        messages = conn.receive()
+                        for message in messages:
                             to_write = self.handle_message(message, conn)
 
                             while to_write:
                                 w_message = to_write.pop()
                                 conn.send_message(w_message)
+                        if messages:
                             self.update_job_distribution()
 
                     except (ClientDisconnectedException, ConnectionResetError) as e:
                         self.handle_conn_error(conn, "Disconnected")
 
-            for s in writeable:
-                conn = self.connections_list.get_by_socket(s)
-                if conn and conn.needs_write():
+            for key, mask in events:
+                conn = self.connections_list.get_by_socket(key.fileobj)
+                if mask & selectors.EVENT_WRITE and conn and conn.needs_write():
                     try:
                         conn.write()
-                    except Exception as e:
-                        # TODO: What exceptions can happen here? Should we resend?
-                        pass
+                    except OSError:
+                        self.handle_conn_error(conn, "Disconnected")
 
             self.operational_check()
 
+    def get_select_timeout(self):
+        """
+        Wait for events until the next deadline, LOOP_INTERVAL_SECONDS at most
+        :return: seconds
+        """
+        next_deadline = self.deadlines.next_deadline()
+        if next_deadline is None:
+            return LOOP_INTERVAL_SECONDS
+        return max(0, min(LOOP_INTERVAL_SECONDS, next_deadline - time.time()))
+
+    def is_connected(self, conn):
+        return self.connections_list.get_by_socket(conn.file_descriptor) is conn
+
     def handle_conn_error(self, conn, error=None):
         conn.return_resources()
+        self.rerun_lost_map_tasks(conn)
         self.connections_list.remove(conn.file_descriptor)
         self.booted_record.append((conn.worker_id, error))
+        self.drop_jobs_of_submitter(conn)
+
+    def drop_jobs_of_submitter(self, conn):
+        """
+        Drop the jobs of a submitter that is gone, nobody is left to tell
+        when they are done. The output of a finished job is kept
+        :param conn:
+        :return:
+        """
+        for submitted_job in [j for j in self.jobs if j.submitter is conn]:
+            finished = submitted_job.finished()
+            fs = submitted_job.get_filesystem()
+            self.mark_job_as_finished(submitted_job)
+            if not finished:
+                fs.remove_output_directory()
 
     # operational_check
     # Performs any operations the server deems necessary to improve performance
     #   and/or handle subtle errors from clients.
     def operational_check(self):
-        if (self.mapping or self.reducing):
+        if self.deadlines.run_expired() and self.jobs:
+            # Tasks of workers that were booted go to the others, which
+            # may be idle and sending nothing
+            self.update_job_distribution()
+
+    def watch_performance(self, now=None):
+        """
+        Run performance_check every PERFORMANCE_CHECK_SECONDS while there are
+        jobs, rather than on every pass of the loop
+        :param now:
+        :return:
+        """
+        now = time.time() if now is None else now
+        self.watching_performance = True
+        self.deadlines.add(now + PERFORMANCE_CHECK_SECONDS, self.check_performance)
+
+    def check_performance(self, now):
+        self.watching_performance = False
+        if self.jobs:
             self.performance_check()
-            self.check_timed_out_heartbeats()
-            self.check_for_dropped_messages()
+            self.watch_performance(now)
 
     # performance_check
-    # If there are nodes in the network that have a processing rate 1000+ times
-    # slower than that of a free node, kick out that worker as it is only
-    # hindering the performance of jobs
+    # Once every task of the running jobs has been handed out, idle workers start a
+    # backup attempt of the running tasks expected to finish last. The first
+    # attempt of a task to finish is kept and the others are cancelled, so
+    # slow workers no longer hold up the phase and are not kicked out
     def performance_check(self):
-        top_rate_and_free = None
-        low_rate = None
+        if not self.connections_list.num_idle():
+            return
+        if any(submitted_job.sub_jobs.num_unassigned() for submitted_job in self.jobs):
+            return
+        # Tasks taken ahead that haven't started run sooner on the idle workers
+        if self.take_back_prefetched_tasks(self.connections_list.num_idle()):
+            self.update_job_distribution()
+            return
 
+        # A worker that hasn't run a task this phase is assumed to be as
+        # fast as the fastest one that has
+        known_rates = [c.byte_processing_rate for c in self.connections_list.connections
+                       if c.subscribed and c.byte_processing_rate > 0]
+        if not known_rates:
+            return
+        fastest_rate = max(known_rates)
+
+        stragglers = []
         for conn in self.connections_list.connections:
-            if (conn.subscribed):
-                if (conn.running == False):
-                    if ((top_rate_and_free is None) or \
-                        (conn.byte_processing_rate > top_rate_and_free.byte_processing_rate)):
-                        top_rate_and_free = conn
-                elif ((low_rate is None) or \
-                    (low_rate.byte_processing_rate != 0 and low_rate.byte_processing_rate > conn.byte_processing_rate)):
-                    low_rate = conn
-
-        # this worker is ready to take on a job if needed
-        if (top_rate_and_free is not None and low_rate is not None):
-            if (low_rate.byte_processing_rate == 0):
-                return
-            multiplier = 1 if not self.reducing else 2 # progress updates twice for reducer
-            # compute the estimated completion time of the job for the low rate worker
-            low_rate_estimated_completion = self.estimate_completion_time(
-                multiplier, low_rate.chunk_size, low_rate.progress, low_rate.byte_processing_rate)
-            top_rate_estimated_completion = self.estimate_completion_time(
-                multiplier, low_rate.chunk_size, 0, top_rate_and_free.byte_processing_rate)
-
-            # print(time.strftime('%H:%M:%S', time.localtime(low_rate_estimated_completion)))
-            # print(time.strftime('%H:%M:%S', time.localtime(top_rate_estimated_completion)))
-            # print(top_rate_estimated_completion - low_rate_estimated_completion)
-
-            if (low_rate_estimated_completion - top_rate_estimated_completion > self.time_buffer):
-                # they took our jobs!!!!!!!!
-                # dey terk er jerbsss!!!
-                self.assign_job(top_rate_and_free, low_rate.current_job)
-                self.handle_conn_error(low_rate, error="Client is too slow")
+            if (conn.running and conn.byte_processing_rate > 0 and conn.current_job and
+                    not conn.current_job.done and len(conn.current_job.attempts) == 1):
+                multiplier = 1 if conn.current_job.instruction_type == 'Mapper' else 2 # progress updates twice for reducer
+                stragglers.append((self.estimate_completion_time(
+                    multiplier, conn.chunk_size, conn.progress, conn.byte_processing_rate), multiplier, conn))
+        stragglers.sort(key=lambda straggler: straggler[0], reverse=True)
+
+        # The fastest idle workers back up the stragglers expected to finish last
+        passed_over = []
+        for estimated_completion, multiplier, straggler in stragglers:
+            idle_conn = self.connections_list.pop_idle()
+            if idle_conn is None:
+                break
+            rate = idle_conn.byte_processing_rate if idle_conn.byte_processing_rate > 0 else fastest_rate
+            backup_estimated_completion = self.estimate_completion_time(
+                multiplier, straggler.chunk_size, 0, rate)
+            if (estimated_completion - backup_estimated_completion > self.time_buffer):
+                self.assign_job(idle_conn, straggler.current_job)
+            else:
+                passed_over.append(idle_conn)
+        for idle_conn in passed_over:
+            self.connections_list.update_state(idle_conn)
+
+    def take_back_prefetched_tasks(self, num_tasks):
+        """
+        Cancel attempts of tasks that clients took ahead and haven't
+        started, so they are assigned again. The ones furthest from
+        starting go first
+        :param num_tasks: at most this many are taken back
+        :return: the number taken back
+        """
+        prefetched = [(position, conn, prefetched_task) for conn in self.connections_list.connections
+                      for position, prefetched_task in enumerate(conn.prefetched_tasks)]
+        prefetched.sort(key=lambda entry: entry[0], reverse=True)
+        for _, conn, prefetched_task in prefetched[:num_tasks]:
+            self.cancel_prefetched_task(conn, prefetched_task)
+        return min(num_tasks, len(prefetched))
+
+    def cancel_prefetched_task(self, conn, prefetched_task):
+        """
+        Cancel the attempt of a task a client took ahead
+        :param conn:
+        :param prefetched_task: [job, attempt_id, has_input] of conn.prefetched_tasks
+        :return:
+        """
+        job, attempt_id, _ = prefetched_task
+        job.remove_attempt(attempt_id)
+        if not job.attempts:
+            job.pending_assignment = False
+        # A client that already started it cancels it, otherwise it drops it from its queue
+        conn.send_message(JobCancelMessage(attempt_id))
+        conn.prefetched_tasks.remove(prefetched_task)
+        conn.update_state()
+
+    def cancel_attempt(self, conn):
+        """
+        Stop a running attempt whose task another attempt finished
+        and free its worker for a new task
+        :param conn:
+        :return:
+        """
+        conn.current_job.remove_attempt(conn.attempt_id)
+        conn.send_message(JobCancelMessage(conn.attempt_id))
+        conn.running = False
+        conn.progress = 0
+        conn.prep_for_new_job()
+        for message in self.start_prefetched_task(conn):
+            conn.send_message(message)
 
     # generic function to estimate completion time
     def estimate_completion_time(self, multiplier, chunk_size, progress, byte_processing_rate):
@@ -385,26 +784,52 @@ class Server(object):
             return 0
         return (multiplier * chunk_size - progress) / byte_processing_rate
 
+    def watch_heartbeats(self, conn, deadline):
+        """
+        Check on a client running an attempt at deadline. Only the
+        attempt running now is watched, see check_heartbeat
+        :param conn:
+        :param deadline: time.time() of the check
+        :return:
+        """
+        attempt_id = conn.attempt_id
+        self.deadlines.add(deadline, lambda now: self.check_heartbeat(conn, attempt_id, now))
+
     # compares last acked heartbeat to current time, disconnects client if difference is
-    # greater than self.heartbeat_allowance
-    def check_timed_out_heartbeats(self):
-        current_time = time.time()
-        timed_out_conns = filter(lambda c: c.running and (current_time - c.last_heartbeat_ack) > self.timeout_allowance, self.connections_list.connections)
-        for conn in timed_out_conns:
+    # greater than self.timeout_allowance
+    def check_heartbeat(self, conn, attempt_id, now):
+        if not self.is_connected(conn) or not conn.running or conn.attempt_id != attempt_id:
+            # The attempt is over, the client is watched again once it starts another
+            return
+        if now - conn.last_heartbeat_ack >= self.timeout_allowance:
             self.handle_conn_error(conn, "Heartbeat timeout")
+            return
+        self.watch_heartbeats(conn, conn.last_heartbeat_ack + self.timeout_allowance)
 
-    def check_for_dropped_messages(self):
+    def expect_ack(self, conn, ack_cls):
         """
-        Check for any workers that haven't ack'd commands
-        or other relevant messages
+        The client must ack within PROTOCOL_TIMEOUT_SECONDS, what it
+        should ack is sent again otherwise
+        :param conn:
+        :param ack_cls: the Message class of the ack
         :return:
         """
-        for connection in self.connections_list.connections:
-            for pair in connection.expected_messages:
-                message_cls, expect_start, num_timeouts = pair
-                now = datetime.now()
-                if expect_start < now - timedelta(seconds=PROTOCOL_TIMEOUT_SECONDS):
-                    self.handle_ack_timeout(pair, connection, self.job_submitter_connection)
+        expected_ack_triplet = [ack_cls, time.time(), 0]
+        conn.expected_messages.append(expected_ack_triplet)
+        self.deadlines.add(expected_ack_triplet[1] + PROTOCOL_TIMEOUT_SECONDS,
+                           lambda now: self.check_ack(conn, expected_ack_triplet, now))
+
+    def check_ack(self, conn, expected_ack_triplet, now):
+        """
+        Check for an ack that should have arrived, unless it did
+        :return:
+        """
+        if not self.is_connected(conn) or not any(e is expected_ack_triplet for e in conn.expected_messages):
+            return
+        self.handle_ack_timeout(expected_ack_triplet, conn)
+        if self.is_connected(conn):
+            self.deadlines.add(now + PROTOCOL_TIMEOUT_SECONDS,
+                               lambda now: self.check_ack(conn, expected_ack_triplet, now))
 
     # serialized job ID
     def get_next_job_id(self):
@@ -461,6 +886,7 @@ class Server(object):
         for c in self.connections_list.connections:
             c.byte_processing_rate = -1
             c.progress = 0
+            c.update_state()
 
     def should_send_job_start(self, conn):
         return conn.data_file_ackd and conn.instructions_ackd
@@ -496,30 +922,102 @@ class Server(object):
         except FileNotFoundError:
             return False
 
-    def handle_ack_timeout(self, expected_ack_triplet, connection, current_job_connection):
+    def get_instructions_message(self, connection):
+        job = connection.current_job
+        return JobInstructionsFileMessage(job.instruction_path, job.instruction_type,
+                                          job.num_partitions, job.partition_num, self.get_job(job.job_name).codec,
+                                          connection.attempt_id, job.num_maps, job.stage, job.previous_output,
+                                          job.job_name)
+
+    def get_data_file_message(self, job):
+        return DataFileMessage(job.data_path, job.data_start, job.data_end,
+                               get_split_cache_key(job) if job.data_path else None)
+
+    def get_task_assign_message(self, job, attempt_id):
+        return TaskAssignMessage(job.instruction_path, job.instruction_type,
+                                 job.num_partitions, job.partition_num, self.get_job(job.job_name).codec,
+                                 attempt_id, job.num_maps, job.stage, job.previous_output,
+                                 job.job_name, job.data_path, job.data_start, job.data_end,
+                                 get_split_cache_key(job) if job.data_path else None)
+
+    def start_attempt(self, connection):
+        """
+        The worker started its attempt
+        :param connection:
+        :return: Message list to write to worker
+        """
+        job = connection.current_job
+        if job is None or self.get_job(job.job_name) is None:
+            # Cancelled while it was being set up
+            return []
+        if not connection.running:
+            self.watch_heartbeats(connection, time.time() + self.timeout_allowance)
+        connection.running = True
+        if job.done:
+            # Another attempt finished while this one was being set up
+            self.cancel_attempt(connection)
+        elif job.instruction_type == 'Reducer':
+            # Output of later map tasks is announced as they finish
+            stage = self.get_job(job.job_name).get_stage(job.stage)
+            return [self.get_map_output_message(connection.attempt_id, j)
+                    for j in stage.map_jobs if j.done and j.map_output]
+        return []
+
+    def send_task_input(self, conn, job):
+        """
+        Stream the lines of a map task's input to a client that doesn't
+        have them, straight from the file
+        :param conn:
+        :param job: the map SubJob
+        :return:
+        """
+        if job.data_end is None:
+            first, last = job.data_start, os.path.getsize(job.data_path)
+        else:
+            first, last = get_split_line_range(job.data_path, job.data_start, job.data_end)
+        conn.send_message(DataStreamMessage(last - first))
+        conn.send_file(job.data_path, first, last - first)
+
+    def handle_ack_timeout(self, expected_ack_triplet, connection):
         expected_ack_triplet[2] += 1
         ack_cls, expected_time_start, num_timeouts = expected_ack_triplet
 
         if num_timeouts >= 3:
             # This worker is "dead". Recoup its job and disconnect.
             connection.return_resources()
-            connection.file_descriptor.close()
+            self.rerun_lost_map_tasks(connection)
             self.connections_list.remove(connection.file_descriptor)
+            connection.file_descriptor.close()
             self.booted_record.append((connection.worker_id, 'Client Unresponsive'))
+            self.drop_jobs_of_submitter(connection)
+            return
+
+        job = connection.current_job
+        if (ack_cls in (JobInstructionsFileAckMessage, DataFileAckMessage, JobStartAckMessage) and
+                (job is None or self.get_job(job.job_name) is None)):
+            # The attempt was cancelled, nothing is sent again
+            connection.expected_messages = [e for e in connection.expected_messages if e is not expected_ack_triplet]
             return
 
         if ack_cls is JobInstructionsFileAckMessage:
-            connection.send_message(
-                JobInstructionsFileMessage(connection.current_job.instruction_path,
-                                           connection.current_job.instruction_type,
-                                           connection.current_job.num_workers, connection.current_job.partition_num)
-            )
+            connection.send_message(self.get_instructions_message(connection))
         elif ack_cls is DataFileAckMessage:
-            connection.send_message(DataFileMessage(connection.current_job.data_path))
+            connection.send_message(self.get_data_file_message(connection.current_job))
         elif ack_cls is JobStartAckMessage:
             connection.send_message(JobStartMessage())
+        elif ack_cls is TaskAssignAckMessage:
+            # The first assignment the client hasn't acked is sent again
+            unacked = [(job, attempt_id) for job, attempt_id, has_input in connection.prefetched_tasks
+                       if has_input is None]
+            if connection.current_job and connection.current_job.pending_assignment:
+                unacked.insert(0, (connection.current_job, connection.attempt_id))
+            unacked = [(job, attempt_id) for job, attempt_id in unacked if self.get_job(job.job_name)]
+            if unacked:
+                connection.send_message(self.get_task_assign_message(*unacked[0]))
         elif ack_cls is SubmittedJobFinishedAckMessage:
-            current_job_connection.send_message(SubmittedJobFinishedMessage())
+            submitted_job = self.get_job_by_submitter(connection)
+            if submitted_job:
+                connection.send_message(SubmittedJobFinishedMessage(submitted_job.output_path))
 
     def handle_message(self, message, connection):
         """
@@ -527,11 +1025,6 @@ class Server(object):
         any necessary operations accordingly
         :param message: The message to handle
         :param connection: The WorkerConnection of this client
-        :param sub_jobs: the sub_jobs list from the server
-        :param initialize_job: The server function to set a new job up on command
-        :param current_job_connection: the conn that corresponds to overall job submitter
-        :param job_finished: the server function to test whether the overall job is finished
-        :param mark_job_as_finished: the server function to prep for new job
         :return: Message list to write to worker
         """
         connection.prev_message = message.m_type
@@ -547,23 +1040,54 @@ class Server(object):
             connection.expected_messages.pop(msg_index)
 
         if message.is_type(MessageTypes.SUBMIT_JOB):
-            if self.job_submitter_connection is not None:
-                return [SubmitJobDeniedMessage(body='Server is busy with another job')]
-
             if self.get_num_subscribed_workers() == 0:
                 return [SubmitJobDeniedMessage(body='No workers available')]
 
             mapper_name = SubmitJobMessage.get_mapper_name(message)
             reducer_name = SubmitJobMessage.get_reducer_name(message)
             data_file_path = SubmitJobMessage.get_data_file_path(message)
+            codec = SubmitJobMessage.get_codec(message)
+            split_size = SubmitJobMessage.get_split_size(message)
+            num_reducers = SubmitJobMessage.get_num_reducers(message)
+            reduce_slowstart = SubmitJobMessage.get_reduce_slowstart(message)
+            pipeline = SubmitJobMessage.get_pipeline(message)
+            incremental = SubmitJobMessage.get_incremental(message)
+            priority = SubmitJobMessage.get_priority(message)
+
+            if pipeline:
+                if not self.is_valid_package_path(pipeline, 'stages'):
+                    return [SubmitJobDeniedMessage(body='{} is an invalid path.'.format(pipeline))]
+                stages = load_pipeline(pipeline)
+                reason = check_pipeline(stages)
+                if reason:
+                    return [SubmitJobDeniedMessage(body=reason)]
+            else:
+                stages = [Stage(None, mapper_name, reducer_name)]
+
+            if incremental:
+                if pipeline:
+                    return [SubmitJobDeniedMessage(body='Pipelines can\'t run incrementally')]
+                if (self.is_valid_package_path(reducer_name, 'Reducer') and
+                        not hasattr(getattr(importlib.import_module(reducer_name), 'Reducer'), 'merge')):
+                    return [SubmitJobDeniedMessage(body='{} can\'t merge runs of an incremental job'.format(reducer_name))]
+                key = get_incremental_key(data_file_path, mapper_name, reducer_name)
+                if [j for j in self.jobs if j.incremental_run and j.incremental_run[0] == key]:
+                    return [SubmitJobDeniedMessage(body='An incremental run of this job is already running')]
 
             invalid_fields = []
-            if not self.is_valid_package_path(mapper_name, 'Mapper'):
-                invalid_fields.append(mapper_name)
-            if not self.is_valid_package_path(reducer_name, 'Reducer'):
-                invalid_fields.append(reducer_name)
+            for stage in stages:
+                if not self.is_valid_package_path(stage.mapper, 'Mapper'):
+                    invalid_fields.append(stage.mapper)
+                if not self.is_valid_package_path(stage.reducer, 'Reducer'):
+                    invalid_fields.append(stage.reducer)
             if not self.is_valid_file_path(data_file_path):
                 invalid_fields.append(data_file_path)
+            if codec and codec not in CODECS:
+                return [SubmitJobDeniedMessage(body='Unknown codec {}'.format(codec))]
+            if (split_size is not None and split_size <= 0) or (num_reducers is not None and num_reducers <= 0):
+                return [SubmitJobDeniedMessage(body='Split size and number of reducers must be positive')]
+            if reduce_slowstart is not None and not 0 <= reduce_slowstart <= 1:
+                return [SubmitJobDeniedMessage(body='Reduce slowstart must be between 0 and 1')]
 
             if invalid_fields:
                 # Not valid
@@ -575,11 +1099,16 @@ class Server(object):
                     )
                 )]
             else:
-                self.initialize_job(connection, mapper_name, reducer_name, data_file_path)
+                self.initialize_job(connection, stages, data_file_path, codec,
+                                    split_size, num_reducers, reduce_slowstart, incremental, priority)
                 return [SubmitJobAckMessage()]
 
         elif message.is_type(MessageTypes.SUBSCRIBE_MESSAGE):
             connection.subscribe()
+            connection.task_assign = SubscribeMessage.get_task_assign(message)
+            connection.prefetch = SubscribeMessage.get_prefetch(message) if connection.task_assign else 0
+            connection.shuffle_address = (SubscribeMessage.get_shuffle_host(message) or connection.address[0],
+                                          SubscribeMessage.get_shuffle_port(message))
             connection.worker_id = 'w-' + ''.join(random.choice(string.ascii_lowercase) for _ in range(5))
             return [SubscribeAckMessage()]
 
@@ -590,12 +1119,11 @@ class Server(object):
             job = connection.current_job
             job.pending_assignment = False
             connection.data_file = job.data_path
-            connection.expected_messages.append([JobInstructionsFileAckMessage, datetime.now(), 0])
-            connection.expected_messages.append([DataFileAckMessage, datetime.now(), 0])
+            self.expect_ack(connection, JobInstructionsFileAckMessage)
+            self.expect_ack(connection, DataFileAckMessage)
             return [
-                JobInstructionsFileMessage(job.instruction_path, job.instruction_type,
-                                           job.num_workers, job.partition_num),
-                DataFileMessage(job.data_path)
+                self.get_instructions_message(connection),
+                self.get_data_file_message(job)
             ]
 
         elif message.is_type(MessageTypes.JOB_INSTRUCTIONS_FILE_ACK):
@@ -603,50 +1131,133 @@ class Server(object):
             connection.instructions_ackd = True
 
             if self.should_send_job_start(connection):
-                connection.expected_messages.append([JobStartAckMessage, datetime.now(), 0])
+                self.expect_ack(connection, JobStartAckMessage)
                 return [JobStartMessage()]
             return []
 
+        elif message.is_type(MessageTypes.TASK_ASSIGN_ACK):
+            attempt_id = TaskAssignAckMessage.get_attempt_id(message)
+            has_data = TaskAssignAckMessage.get_has_data(message)
+            prefetched = connection.get_prefetched_task(attempt_id)
+            if prefetched:
+                # A task taken ahead, it starts once the tasks before it are done
+                if prefetched[2] is None:
+                    prefetched[0].pending_assignment = False
+                    prefetched[2] = has_data
+                    if not has_data:
+                        self.send_task_input(connection, prefetched[0])
+                return []
+
+            job = connection.current_job
+            if attempt_id != connection.attempt_id or not job.pending_assignment:
+                # The ack of an assignment that was sent again
+                return []
+            job.pending_assignment = False
+            connection.data_file = job.data_path
+            if not has_data:
+                # The client starts the task and acks the input once it has received it
+                self.send_task_input(connection, job)
+                return []
+            return self.start_attempt(connection)
+
         elif message.is_type(MessageTypes.DATAFILE_ACK):
+            if not DataFileAckMessage.get_has_data(message):
+                # The client acks again once it has received the input
+                self.send_task_input(connection, connection.current_job)
+                return []
+            attempt_id = DataFileAckMessage.get_attempt_id(message)
+            prefetched = connection.get_prefetched_task(attempt_id)
+            if prefetched:
+                prefetched[2] = True
+                return []
+            if connection.task_assign:
+                # The streamed input of a TASK_ASSIGN is in, the task started
+                if attempt_id != connection.attempt_id or connection.running:
+                    return []
+                return self.start_attempt(connection)
             connection.data_file_ackd = True
 
             if self.should_send_job_start(connection):
-                connection.expected_messages.append([JobStartAckMessage, datetime.now(), 0])
+                self.expect_ack(connection, JobStartAckMessage)
                 return [JobStartMessage()]
             return []
 
         elif message.is_type(MessageTypes.JOB_START_ACK):
-            connection.running = True
-            return []
+            return self.start_attempt(connection)
 
         elif message.is_type(MessageTypes.JOB_DONE):
-            connection.result_file = message.get_body()
+            attempt_id = JobDoneMessage.get_attempt_id(message)
+            if attempt_id != connection.attempt_id:
+                # An attempt that was cancelled after it had already finished,
+                # the worker removes its files when the cancel arrives
+                return [JobDoneAckMessage()]
 
             # End job
             connection.running = False
             job = connection.current_job
+            submitted_job = self.get_job(job.job_name)
+            if submitted_job is None:
+                # The job was over before the attempt finished, its output isn't needed
+                job.remove_attempt(attempt_id)
+                connection.prep_for_new_job()
+                return [JobDoneAckMessage(), JobCancelMessage(attempt_id)] + self.start_prefetched_task(connection)
+            if job.instruction_type == 'Mapper':
+                # The output stays on the worker, reducers fetch it from its shuffle server
+                job.map_output = connection.shuffle_address + (attempt_id,)
+                job.output_size = JobDoneMessage.get_output_size(message) or 0
+                if job.fingerprint and self.map_cache.max_size:
+                    self.cache_map_output(job)
+            else:
+                submitted_job.get_stage(job.stage).get_filesystem().commit_attempt(attempt_id)
+            # Attempts still being set up are cancelled once they start
+            for conn in list(job.attempts.values()):
+                if conn is not connection and conn.running and conn.current_job is job:
+                    self.cancel_attempt(conn)
             job.post_execute(connection.result_file)
-
-            if self.job_finished():  # Overall job
-                self.job_submitter_connection.expected_messages.append([SubmittedJobFinishedAckMessage, datetime.now(), 0])
-                self.job_submitter_connection.send_message(
-                    SubmittedJobFinishedMessage()
+            if job.map_output:
+                self.announce_map_output(job)
+
+            # Only the last reducer finishes the job, map tasks run again may finish after it
+            if job.instruction_type == 'Reducer' and submitted_job.finished():  # Overall job
+                if submitted_job.incremental_run:
+                    self.save_incremental_run(submitted_job)
+                self.expect_ack(submitted_job.submitter, SubmittedJobFinishedAckMessage)
+                submitted_job.submitter.send_message(
+                    SubmittedJobFinishedMessage(submitted_job.output_path)
                 )
 
-            # Reset this connection so that it can be assigned a new job
+            # Reset this connection so that it can be assigned a new job,
+            # or goes on with a task it took ahead
             connection.prep_for_new_job()
 
-            return [JobDoneAckMessage()]
+            return [JobDoneAckMessage()] + self.start_prefetched_task(connection)
+
+        elif message.is_type(MessageTypes.MAP_OUTPUT_LOST):
+            # A reducer couldn't fetch a map task's output. Reports about
+            # output that was already replaced are ignored
+            reducer = connection.current_job
+            submitted_job = reducer and self.get_job(reducer.job_name)
+            if submitted_job:
+                stage = submitted_job.get_stage(reducer.stage)
+                map_id = MapOutputLostMessage.get_map_id(message)
+                output_id = MapOutputLostMessage.get_output_id(message)
+                for job in stage.map_jobs:
+                    if job.id == map_id and job.done and job.map_output and job.map_output[2] == output_id:
+                        self.rerun_map_task(stage, job)
+            return []
 
         elif message.is_type(MessageTypes.SUBMITTED_JOB_FINISHED_ACK):
-            self.mark_job_as_finished()
+            submitted_job = self.get_job_by_submitter(connection)
+            if submitted_job:
+                self.mark_job_as_finished(submitted_job)
 
         elif message.is_type(MessageTypes.JOB_HEARTBEAT):
             # TODO use heartbeat rate to keep track of most efficient clients
             progress = JobHeartbeatMessage.get_progress(message)
             rate = JobHeartbeatMessage.get_rate(message)
 
-            connection.progress = int(progress)
-            connection.byte_processing_rate = float(rate)
+            connection.progress = progress
+            connection.byte_processing_rate = rate
+            connection.map_outputs_fetched = JobHeartbeatMessage.get_map_outputs_fetched(message)
 
             return []
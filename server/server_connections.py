@@ -1,3 +1,7 @@
+import heapq
+from collections import deque
+from itertools import count
+
 from connection import PMRConnection
 from messages import MessageTypes
 import time
@@ -5,22 +9,37 @@ import time
 
 class WorkerConnection(PMRConnection):
     def __init__(self, file_descriptor, address=None):
+        # The ConnectionsList the connection is in, told when its task changes
+        self.connections_list = None
         self.subscribed = False
         self.worker_id = ''
         self.prev_message = None
         self.job_id = None
-        self.current_job = None
+        self._current_job = None
+        self.attempt_id = None
 
         self.instructions_ackd = False
         self.data_file_ackd = False
 
         self.progress = 0
+        # Whether the worker's reducer has fetched all of its map output
+        self.map_outputs_fetched = False
         self.byte_processing_rate = -1
         self.last_heartbeat_ack = -1
 
         self.result_file = None
         self.data_file = None
 
+        # (host, port) of the worker's shuffle server, sent when it subscribes
+        self.shuffle_address = None
+        # Whether the worker takes a task in one TASK_ASSIGN instead of the
+        # step by step handshake
+        self.task_assign = False
+        # Map tasks the worker takes ahead of its current one, and the ones
+        # assigned ahead: [job, attempt_id, has_input] in the order it runs them
+        self.prefetch = 0
+        self.prefetched_tasks = deque()
+
         # Messages that this conn needs to receive
         # A list of tuples (message_cls, expect_start_time, num_timeouts)
         self.expected_messages = []
@@ -39,8 +58,22 @@ class WorkerConnection(PMRConnection):
             data_file = self.data_file,
         )
 
+    @property
+    def current_job(self):
+        return self._current_job
+
+    @current_job.setter
+    def current_job(self, job):
+        self._current_job = job
+        self.update_state()
+
+    def update_state(self):
+        if self.connections_list:
+            self.connections_list.update_state(self)
+
     def subscribe(self):
         self.subscribed = True
+        self.update_state()
 
     def prep_for_new_job(self):
         """
@@ -53,10 +86,12 @@ class WorkerConnection(PMRConnection):
         self.prev_message = MessageTypes.SUBSCRIBE_MESSAGE
         self.job_id = None
         self.current_job = None
+        self.attempt_id = None
         self.instructions_ackd = False
         self.data_file_ackd = False
         self.data_file = None
         self.result_file = None
+        self.map_outputs_fetched = False
 
     def return_resources(self):
         """
@@ -66,53 +101,143 @@ class WorkerConnection(PMRConnection):
         :return:
         """
         if self.current_job:
-            self.current_job.client = None
-            self.current_job.pending_assignment = False
-            self.current_job.done = False
+            self.current_job.remove_attempt(self.attempt_id)
+            if not self.current_job.attempts:
+                self.current_job.pending_assignment = False
+                self.current_job.done = False
+        for job, attempt_id, _ in self.prefetched_tasks:
+            job.remove_attempt(attempt_id)
+            if not job.attempts:
+                job.pending_assignment = False
+        self.prefetched_tasks.clear()
+
+    def get_prefetched_task(self, attempt_id):
+        """
+        :param attempt_id:
+        :return: [job, attempt_id, has_input] of a task taken ahead, None if it isn't one
+        """
+        for prefetched in self.prefetched_tasks:
+            if prefetched[1] == attempt_id:
+                return prefetched
+        return None
 
 
 class ConnectionsList(object):
     """
-    The set of connections
+    The set of connections, indexed by socket and registered with a
+    selector so the server loop gets the connection of each event directly
     """
-    def __init__(self):
-        self.connections = []
+    def __init__(self, selector):
+        self.selector = selector
+        # socket -> WorkerConnection, in the order connections were added
+        self._connections = dict()
+
+        # Connections running a map task that take more tasks ahead of it
+        self._prefetching = set()
+
+        # Subscribed connections without a task -> their entry in the idle
+        # heap, (-rate, sequence number, connection) so the fastest is first.
+        # Entries of connections that were given a task since, or whose rate
+        # changed, are dropped when they reach the top
+        self._idle = dict()
+        self._idle_heap = []
+        self._idle_sequence = count()
 
     def __str__(self):
         return '<ConnectionsList: [{conn_list}]>'.format(
             conn_list=',\n\t'.join([str(c) for c in self.connections])
         )
 
+    @property
+    def connections(self):
+        return list(self._connections.values())
+
     def add(self, connection):
-        # TODO: check to make sure the connection doesn't already exist
-        self.connections.append(connection)
+        if connection.file_descriptor in self._connections:
+            return
+        self._connections[connection.file_descriptor] = connection
+        connection.register(self.selector)
+        connection.connections_list = self
+        self.update_state(connection)
 
     def get_by_socket(self, sock):
-        for connection in self.connections:
-            if connection.file_descriptor == sock:
-                return connection
-        return None
+        return self._connections.get(sock)
 
     def remove(self, file_descriptor):
-        for index, connection in enumerate(self.connections):
-            if connection.file_descriptor == file_descriptor:
-                del self.connections[index]
-
-    def get_read_set(self):
-        # TODO: Add any filtering necessary
-        return map((lambda x: x.file_descriptor), self.connections)
-
-    def get_write_set(self):
-        return map(
-            lambda x: x.file_descriptor,
-            filter(lambda x: x.needs_write(), self.connections)
-        )
+        connection = self._connections.pop(file_descriptor, None)
+        if connection:
+            self._drop(connection)
 
     def empty(self):
-        return not self.connections
+        return not self._connections
 
     def pop(self):
-        return self.connections.pop()
+        _, connection = self._connections.popitem()
+        self._drop(connection)
+        return connection
+
+    def _drop(self, connection):
+        connection.unregister()
+        connection.drop_write_buffer()
+        connection.connections_list = None
+        self._idle.pop(connection, None)
+        self._prefetching.discard(connection)
+
+    def update_state(self, connection):
+        """
+        Called when a connection's task or the tasks it took ahead changed,
+        or its processing rate changed while it is idle
+        :param connection:
+        :return:
+        """
+        job = connection.current_job
+        if job and job.instruction_type == 'Mapper' and len(connection.prefetched_tasks) < connection.prefetch:
+            self._prefetching.add(connection)
+        else:
+            self._prefetching.discard(connection)
+
+        if not (connection.subscribed and job is None):
+            self._idle.pop(connection, None)
+            return
+
+        entry = (-connection.byte_processing_rate, next(self._idle_sequence), connection)
+        self._idle[connection] = entry
+        heapq.heappush(self._idle_heap, entry)
+        if len(self._idle_heap) > 2 * len(self._idle) + 64:
+            # Most entries are stale
+            self._idle_heap = list(self._idle.values())
+            heapq.heapify(self._idle_heap)
+
+    def get_prefetching(self):
+        """
+        Connections running a map task that take more tasks ahead of it,
+        except those that haven't read what was already sent to them
+        :return: list of WorkerConnection
+        """
+        return [c for c in self._prefetching if not c.is_backed_up()]
+
+    def num_idle(self):
+        return len(self._idle)
 
-    def sort(self, key_func=lambda x: x, reverse_opt=True):
-        self.connections = sorted(self.connections, key=key_func, reverse=reverse_opt)
+    def pop_idle(self):
+        """
+        Take the fastest idle connection. Connections that haven't read
+        what was already sent to them are passed over until they catch up
+        A connection that isn't given a task is put back with update_state
+        :return: WorkerConnection or None
+        """
+        connection = None
+        backed_up = []
+        while self._idle_heap:
+            entry = heapq.heappop(self._idle_heap)
+            if self._idle.get(entry[2]) is not entry:
+                continue
+            if entry[2].is_backed_up():
+                backed_up.append(entry)
+                continue
+            connection = entry[2]
+            del self._idle[connection]
+            break
+        for entry in backed_up:
+            heapq.heappush(self._idle_heap, entry)
+        return connection
@@ -0,0 +1,106 @@
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from filesystems import is_plain_name
+
+# Sent ahead of a map output partition, its size or -1 if it isn't there
+SIZE_HEADER = struct.Struct('!q')
+
+# Bytes of a map output read from a peer per recv
+FETCH_BUFFER_SIZE = 1 << 16
+
+# Seconds a fetch waits on a peer that stopped sending before giving up
+FETCH_TIMEOUT = 10
+
+
+class ShuffleFetchError(Exception):
+    """
+    A map output could not be fetched, the node holding it is gone or
+    no longer has it
+    """
+    pass
+
+
+class _ShuffleRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8').split()
+        path = None
+        if len(request) == 2 and is_plain_name(request[0]) and request[1].isdigit():
+            path = self.server.get_map_output_file(request[0], int(request[1]))
+
+        try:
+            file = open(path, 'rb') if path else None
+        except OSError:
+            file = None
+        if file is None:
+            self.wfile.write(SIZE_HEADER.pack(-1))
+            return
+
+        with file:
+            self.wfile.write(SIZE_HEADER.pack(os.fstat(file.fileno()).st_size))
+            self.request.sendfile(file)
+
+
+class ShuffleServer(socketserver.ThreadingTCPServer):
+    """
+    Serves the map output kept on this node to reducers, each request
+    on its own thread
+
+    A request is a line '<output id> <partition number>', it is answered
+    with the size of the partition's file then the file itself
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, get_map_output_file, host='', port=0):
+        """
+        :param get_map_output_file: function (output id, partition number) -> path or None
+        :param host: address to bind to, all of them by default
+        :param port: port to bind to, any free one by default
+        """
+        super().__init__((host, port), _ShuffleRequestHandler)
+        self.get_map_output_file = get_map_output_file
+        self.port = self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def fetch_map_output(location, partition_num, path):
+    """
+    Copy a partition of a map output from the node that holds it
+    :param location: (host, port, output id)
+    :param partition_num:
+    :param path: file to copy it to
+    :return: path
+    """
+    host, port, output_id = location
+    try:
+        with socket.create_connection((host, port), timeout=FETCH_TIMEOUT) as sock:
+            sock.sendall('{} {}\n'.format(output_id, partition_num).encode('utf-8'))
+            with sock.makefile('rb') as stream, open(path, 'wb') as file:
+                header = stream.read(SIZE_HEADER.size)
+                if len(header) < SIZE_HEADER.size:
+                    raise ShuffleFetchError('{}:{} closed the connection'.format(host, port))
+                size, = SIZE_HEADER.unpack(header)
+                if size < 0:
+                    raise ShuffleFetchError('{}:{} doesn\'t have {}'.format(host, port, output_id))
+
+                buffer = bytearray(FETCH_BUFFER_SIZE)
+                remaining = size
+                while remaining:
+                    received = stream.readinto(memoryview(buffer)[:min(remaining, len(buffer))])
+                    if not received:
+                        raise ShuffleFetchError('{}:{} closed the connection'.format(host, port))
+                    file.write(memoryview(buffer)[:received])
+                    remaining -= received
+    except OSError as e:
+        raise ShuffleFetchError(str(e))
+    return path
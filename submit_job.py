@@ -3,13 +3,16 @@ import select
 from optparse import OptionParser
 
 from connection import PMRConnection
-from messages import MessageTypes, SubmitJobMessage, SubmittedJobFinishedMessage, SubmittedJobFinishedAckMessage
+from messages import MessageTypes, SubmitJobMessage, SubmitJobDeniedMessage, SubmittedJobFinishedMessage, SubmittedJobFinishedAckMessage
 
 """
 A command file for submitting jobs to the
 
 To run the avg query time job:
 python submit_job.py -d queries.txt -m PMRProcessing.mapper.average_query_time -r PMRProcessing.reducer.average_query_time
+
+To run the two stage word frequency pipeline:
+python submit_job.py -d brown.txt --pipeline PMRProcessing.pipeline.word_frequency
 """
 
 
@@ -31,6 +34,27 @@ def parse_opts():
                       default='PMRProcessing.reducer.word_count')
     parser.add_option('-d', '--datafile', dest='datafile',
                       help='the datafile path', type='string', default='brown.txt')
+    parser.add_option('-c', '--codec', dest='codec',
+                      help='compress intermediate and output files with zlib, bz2 or lzma',
+                      type='string', default=None)
+    parser.add_option('--split-size', dest='split_size',
+                      help='bytes of input per map task (default: a few tasks per worker)',
+                      type='int', default=None)
+    parser.add_option('--reducers', dest='reducers',
+                      help='number of reduce tasks (default: one per worker)',
+                      type='int', default=None)
+    parser.add_option('--reduce-slowstart', dest='reduce_slowstart',
+                      help='fraction of map tasks done before reduce tasks are scheduled (default: 0.8)',
+                      type='float', default=None)
+    parser.add_option('--pipeline', dest='pipeline',
+                      help='package path of a pipeline of stages to run instead of a single mapper and reducer',
+                      type='string', default=None)
+    parser.add_option('-i', '--incremental', dest='incremental',
+                      help='only map input appended since the last incremental run and merge with its output',
+                      action='store_true', default=False)
+    parser.add_option('--priority', dest='priority',
+                      help='jobs with a higher priority get idle workers first (default: 0)',
+                      type='int', default=0)
     return parser.parse_args()
 
 
@@ -47,41 +71,46 @@ def main():
     connection.send_message(SubmitJobMessage(
         mapper_name=options.mapper,
         reducer_name=options.reducer,
-        data_file_path=options.datafile
+        data_file_path=options.datafile,
+        codec=options.codec,
+        split_size=options.split_size,
+        num_reducers=options.reducers,
+        reduce_slowstart=options.reduce_slowstart,
+        pipeline=options.pipeline,
+        incremental=options.incremental,
+        priority=options.priority
     ))
     connection.write()
 
     # Wait for ack
+    # The job's completion can arrive along with the ack
     job_accepted = False
-    complete = False
-    while not complete:
+    messages = []
+    while not messages:
         readable, _, _ = select.select([sock], [], [])
         if readable:
-            message = connection.receive()
-            if message:
-                complete = True
+            messages = connection.receive()
+    message = messages.pop(0)
 
     if message and message.is_type(MessageTypes.SUBMIT_JOB_ACK):
         job_accepted = True
         print('Server acknowledged job submission')
     elif message and message.is_type(MessageTypes.SUBMIT_JOB_DENIED):
-        print('Job denied: {}'.format(message.get_body()))
+        print('Job denied: {}'.format(SubmitJobDeniedMessage.get_reason(message)))
     else:
         print(message)
         print('Received unexpected message from server')
 
     if job_accepted:
         # Wait for job completion
-        complete = False
-        while not complete:
+        while not messages:
             readable, _, _ = select.select([sock], [], [])
             if readable:
-                message = connection.receive()
-                if message:
-                    complete = True
+                messages = connection.receive()
+        message = messages.pop(0)
 
         if message.is_type(MessageTypes.SUBMITTED_JOB_FINISHED):
-            print('Job finished. Output located in /output')
+            print('Job finished. Output located in {}'.format(SubmittedJobFinishedMessage.get_output_path(message)))
         else:
             print('Received unexpected message from server')
 